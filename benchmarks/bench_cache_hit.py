@@ -0,0 +1,44 @@
+"""
+Per-response overhead of the after request hook on a cache hit.
+
+    python -m benchmarks.bench_cache_hit
+"""
+import asyncio
+import time
+
+from quart import Quart, Response
+
+from quart_minify.minify import Minify
+
+ROUNDS = 2000
+PAGE = (
+    "<html><head><style>body { color: red; }</style></head><body>"
+    + "<p>  paragraph  </p>" * 200
+    + "<script>console.log('a');  var x = 1;</script>" * 20
+    + "</body></html>"
+)
+
+
+async def bench(label, minify, app, clear_responses):
+    async with app.test_request_context("/"):
+        await minify.to_loop_tag(Response(PAGE))
+        started = time.perf_counter()
+        for _ in range(ROUNDS):
+            if clear_responses:
+                minify.responses.clear()
+            await minify.to_loop_tag(Response(PAGE))
+        elapsed = time.perf_counter() - started
+
+    print(f"{label:<24} {elapsed / ROUNDS * 1e6:8.1f} us/response")
+
+
+async def main():
+    app = Quart(__name__)
+    minify = Minify(app=app, remove_console=True, remove_debugger=True)
+
+    await bench("response cache hit", minify, app, clear_responses=False)
+    await bench("fragment cache hit", minify, app, clear_responses=True)
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,64 @@
+"""
+Memory per cache entry of minified fragments, held as str values in a plain
+LRU dict against the compact entries of MinifyCache, uncompressed and with
+cold entries compressed.
+
+    python -m benchmarks.bench_cache_memory
+"""
+from collections import OrderedDict
+import tracemalloc
+
+from quart_minify.cache import MinifyCache
+
+ENTRIES = 2000
+FRAGMENT = (
+    '<tr class=row><td class=name>Produit {index} – édition été<td class=price>{price} €'
+    '<td><a href=/products/{index} title="Product {index}">details</a></tr>'
+)
+
+
+def fragments():
+    # Generated while traced, as minified fragments are, the cache keeps what it holds
+    for index in range(ENTRIES):
+        yield f"fingerprint:html:{index:09d}", "".join(
+            FRAGMENT.format(index=index * 10 + row, price=row * 3 % 97) for row in range(8)
+        )
+
+
+def measure(label, fill):
+    tracemalloc.start()
+    holder = fill(fragments())
+    used = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+
+    size = sum(len(value.encode("utf8")) for key, value in fragments()) / ENTRIES
+    print(f"{label:<24} {used / ENTRIES:8.0f} bytes/entry  ({size:.0f} bytes of UTF-8 values)")
+    return holder
+
+
+def plain(values):
+    # The previous layout, str values and a separate hit count per key
+    entries, hits = OrderedDict(), {}
+    for key, value in values:
+        entries[key] = value
+        hits[key] = 0
+    return entries, hits
+
+
+def compact(values, compress=False):
+    cache = MinifyCache(ENTRIES)
+    for key, value in values:
+        cache.set(key, value)
+    if compress:
+        cache.compress()
+    return cache
+
+
+def main():
+    measure("str values", plain)
+    measure("entries", compact)
+    measure("compressed entries", lambda values: compact(values, compress=True))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,67 @@
+"""
+Replays a cache key trace against every eviction policy, comparing the hit
+ratios and the time per operation. The default trace mixes Zipf distributed
+page fragments with crawler scans of fragments read once, a file with one
+key per line can be replayed instead.
+
+    python -m benchmarks.bench_cache_policies [trace.txt]
+"""
+import random
+import sys
+import time
+
+from quart_minify.cache import CACHE_POLICIES, MinifyCache
+
+LIMIT = 1000
+REQUESTS = 200000
+HOT_KEYS = 5000
+SCAN_EVERY = 20000  # requests between crawler scans
+SCAN_LENGTH = 4000  # unique keys per scan
+VALUE = "<p>fragment</p>"
+
+
+def synthetic_trace(seed=0):
+    generator = random.Random(seed)
+    weights = [1 / (rank + 1) ** 0.9 for rank in range(HOT_KEYS)]
+    keys = generator.choices(range(HOT_KEYS), weights, k=REQUESTS)
+    trace = []
+    scan = 0
+
+    for index, key in enumerate(keys):
+        trace.append(f"hot{key}")
+        if index % SCAN_EVERY == SCAN_EVERY - 1:
+            trace.extend(f"scan{scan}:{page}" for page in range(SCAN_LENGTH))
+            scan += 1
+
+    return trace
+
+
+def replay(trace, policy, limit):
+    cache = MinifyCache(limit, policy=policy)
+    started = time.perf_counter()
+
+    for key in trace:
+        if cache.get(key) is None:
+            cache.set(key, VALUE)
+
+    elapsed = time.perf_counter() - started
+    return cache.stats()["hit_ratio"], elapsed / len(trace)
+
+
+def main():
+    if len(sys.argv) > 1:
+        with open(sys.argv[1]) as trace_file:
+            trace = [line.strip() for line in trace_file if line.strip()]
+    else:
+        trace = synthetic_trace()
+
+    print(f"{len(trace)} requests, {len(set(trace))} keys")
+    print(f"{'limit':>6} {'policy':>8} {'hit ratio':>10} {'per op':>10}")
+    for limit in (LIMIT // 4, LIMIT, LIMIT * 4):
+        for policy in CACHE_POLICIES:
+            hit_ratio, per_operation = replay(trace, policy, limit)
+            print(f"{limit:>6} {policy:>8} {hit_ratio:>10.3f} {per_operation * 1e9:>7.0f} ns")
+
+
+if __name__ == "__main__":
+    main()
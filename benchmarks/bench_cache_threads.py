@@ -0,0 +1,44 @@
+"""
+Cache operations per second shared by 1 to 16 threads, with a single lock
+and with lock striped shards.
+
+    python -m benchmarks.bench_cache_threads
+"""
+from concurrent.futures import ThreadPoolExecutor
+import time
+
+from quart_minify.cache import MinifyCache
+
+OPERATIONS = 200000
+KEYS = [f"fragment{index}" for index in range(1000)]
+
+
+def work(cache, count, offset):
+    for index in range(count):
+        key = KEYS[(index + offset) % len(KEYS)]
+        if cache.get(key) is None:
+            cache.set(key, key)
+
+
+def bench(threads, shards):
+    cache = MinifyCache(500, shards=shards)
+    count = OPERATIONS // threads
+
+    with ThreadPoolExecutor(max_workers=threads) as executor:
+        started = time.perf_counter()
+        list(executor.map(work, [cache] * threads, [count] * threads, range(0, threads * 37, 37)))
+        elapsed = time.perf_counter() - started
+
+    return OPERATIONS / elapsed
+
+
+def main():
+    print(f"{'threads':>7} {'1 shard':>14} {'16 shards':>14}")
+    for threads in (1, 2, 4, 8, 16):
+        print(
+            f"{threads:>7} {bench(threads, 1):>10.0f} op/s {bench(threads, 16):>10.0f} op/s"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,75 @@
+"""
+Whole document against chunked minification of templated pages that only
+differ in a few dynamic regions, which always miss the response cache.
+
+    python -m benchmarks.bench_chunks
+"""
+import time
+
+from quart_minify.minify import Minify
+
+PAGES = 200
+ROW = """
+        <tr class="row">
+          <td class="name">  Product {index}  </td>
+          <td class="price">  {price} EUR  </td>
+          <td>  <a href="/products/{index}" title="Product {index}">  details  </a>  </td>
+        </tr>"""
+PAGE = """<!doctype html>
+<html>
+  <head>
+    <title>  Products  </title>
+    <meta name="csrf-token" content="{token}">
+  </head>
+  <body>
+    <header class="top">
+      <nav>  <a href="/">  Home  </a>  <a href="/account">  {user}  </a>  </nav>
+    </header>
+    <main class="content">
+      <table class="products">{rows}
+      </table>
+    </main>
+    <footer>  Rendered at {timestamp}  </footer>
+  </body>
+</html>"""
+ROWS = "".join(ROW.format(index=index, price=index * 3 % 97) for index in range(300))
+
+
+def render(number):
+    return PAGE.format(
+        token=f"{number * 7919:032x}",
+        user=f"user{number}",
+        timestamp=f"2024-01-01T00:00:{number % 60:02d}",
+        rows=ROWS,
+    )
+
+
+def bench(label, minify, pages):
+    started = time.perf_counter()
+    for page in pages:
+        minified = minify._minify_document(page)
+    elapsed = time.perf_counter() - started
+
+    stats = minify.history.stats()
+    print(
+        f"{label:<28} {elapsed / len(pages) * 1e3:7.2f} ms/page"
+        f"  {len(minified)} characters  chunk hit ratio {stats['hit_ratio']:.2f}"
+    )
+
+
+def main():
+    pages = [render(number) for number in range(PAGES)]
+    print(f"{PAGES} pages of {len(pages[0])} characters")
+
+    for engine in ("minify_html_onepass", "minify_html"):
+        engines = {"html": engine}
+        bench(f"{engine} whole", Minify(engines=engines), pages)
+        bench(
+            f"{engine} chunked",
+            Minify(engines=engines, chunked=True, cache_limit=1000),
+            pages,
+        )
+
+
+if __name__ == "__main__":
+    main()
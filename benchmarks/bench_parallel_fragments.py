@@ -0,0 +1,73 @@
+"""
+Latency of a page with many large inline scripts missing the cache, minified
+in a single executor call, one call per fragment and batches minified in
+parallel, on thread and process pools. Parallel batches only pay off with
+several cores, and engines releasing the GIL on thread pools.
+
+    python -m benchmarks.bench_parallel_fragments
+"""
+import asyncio
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+import os
+import time
+
+from quart_minify.minify import Minify
+
+SCRIPTS = 30
+REPEAT = 20  # copies of the widget per script
+PAGES = 20
+SCRIPT = """
+    // Widget {index}
+    function widget{index}(element, options) {{
+        var settings = {{ delay: 100, retries: 3, label: "widget {index}" }};
+        for (var key in options) {{
+            if (options.hasOwnProperty(key)) {{ settings[key] = options[key]; }}
+        }}
+        element.addEventListener("click", function (event) {{
+            event.preventDefault();
+            return settings.label + " " + event.target.id;
+        }});
+    }}
+"""
+
+
+def render(number):
+    scripts = "".join(
+        f"<script>{SCRIPT.format(index=index) * REPEAT}/* {number} */</script>\n"
+        for index in range(SCRIPTS)
+    )
+    return f"<html><body>{scripts}</body></html>"
+
+
+async def bench(label, executor, batch_size):
+    minify = Minify(
+        cache=False, html=False, js=True, executor=executor, executor_batch_size=batch_size
+    )
+    pages = [render(number) for number in range(PAGES)]
+    await minify._minify_document_async(pages[0])
+
+    started = time.perf_counter()
+    for page in pages:
+        await minify._minify_document_async(page)
+    elapsed = time.perf_counter() - started
+
+    print(f"{label:<32} {elapsed / PAGES * 1e3:7.2f} ms/page")
+
+
+async def main():
+    workers = os.cpu_count() or 1
+    print(f"{SCRIPTS} scripts of {len(SCRIPT) * REPEAT} characters, {workers} cores")
+
+    with ThreadPoolExecutor(workers) as executor:
+        await bench("threads, single batch", executor, 1 << 30)
+        await bench("threads, call per fragment", executor, 1)
+        await bench("threads, parallel batches", executor, 8192)
+
+    with ProcessPoolExecutor(workers) as executor:
+        await bench("processes, single batch", executor, 1 << 30)
+        await bench("processes, call per fragment", executor, 1)
+        await bench("processes, parallel batches", executor, 8192)
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
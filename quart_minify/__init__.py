@@ -1,3 +1,4 @@
+from quart_minify.engines import Engine, register_engine
 from quart_minify.minify import Minify
 
-__all__ = ["Minify"]
+__all__ = ["Engine", "Minify", "register_engine"]
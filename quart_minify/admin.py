@@ -0,0 +1,72 @@
+import hmac
+
+from quart import Blueprint, abort, jsonify, request
+
+LOCAL_ADDRESSES = frozenset(("127.0.0.1", "::1"))
+TOKEN_HEADER = "X-Minify-Token"
+
+
+def create_admin_blueprint(minify, token, local_only=True, name="minify_admin"):
+    """
+    Create a blueprint exposing the cache administration API of a Minify instance.
+    @param: minify The Minify instance
+    @param: token Token required in the X-Minify-Token header
+    @param: local_only Only allow requests from the loopback addresses (default: True)
+    @param: name The blueprint name (default: 'minify_admin')
+    @return: Blueprint, to register with the app under an url_prefix
+    """
+    if not isinstance(token, str) or not token:
+        raise ValueError("create_admin_blueprint() requires a token")
+
+    blueprint = Blueprint(name, __name__)
+
+    @blueprint.before_request
+    async def protect():
+        if local_only and request.remote_addr not in LOCAL_ADDRESSES:
+            abort(403)
+
+        # Compared as bytes, compare_digest raises on non-ASCII str
+        sent = request.headers.get(TOKEN_HEADER, "").encode("utf8")
+        if not hmac.compare_digest(sent, token.encode("utf8")):
+            abort(403)
+
+    @blueprint.route("/stats")
+    async def stats():
+        return jsonify(minify.cache_stats())
+
+    @blueprint.route("/entries")
+    async def entries():
+        count = request.args.get("count", 10, type=int)
+        by = request.args.get("by", "size")
+
+        if by not in ("size", "hits"):
+            abort(400)
+
+        return jsonify(minify.top_entries(count, by))
+
+    @blueprint.route("/invalidate", methods=["POST"])
+    async def invalidate():
+        data = await request.get_json(silent=True) or {}
+
+        if not data.get("digest"):
+            abort(400)
+
+        return jsonify({"invalidated": minify.invalidate(digest=data["digest"])})
+
+    @blueprint.route("/clear", methods=["POST"])
+    async def clear():
+        minify.clear_cache()
+        return jsonify(minify.cache_stats())
+
+    @blueprint.route("/resize", methods=["POST"])
+    async def resize():
+        data = await request.get_json(silent=True) or {}
+        limit = data.get("limit")
+
+        if not isinstance(limit, int) or limit < 1:
+            abort(400)
+
+        minify.resize(limit)
+        return jsonify(minify.cache_stats())
+
+    return blueprint
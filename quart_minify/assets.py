@@ -0,0 +1,414 @@
+from hashlib import md5
+import os
+import re
+import tempfile
+import time
+from urllib.parse import urlsplit
+
+from quart import Response, abort
+from werkzeug.security import safe_join
+
+from quart_minify.cache import MinifyCache
+from quart_minify.jinja import PLACEHOLDER_PATTERN
+
+ASSET_TAGS = r'<script\b([^>]*)>\s*</script>|<link\b([^>]*)>'
+ASSET_TAGS_PATTERNS = (
+    re.compile(ASSET_TAGS, re.IGNORECASE),
+    re.compile(ASSET_TAGS.encode(), re.IGNORECASE),
+)
+ATTRIBUTE = re.compile(r'([^\s=/>]+)(?:\s*=\s*("[^"]*"|\'[^\']*\'|[^\s>]+))?')
+# Scripts whose execution order changes once inline
+DEFERRED_SCRIPT = frozenset(("defer", "async", "nomodule"))
+# Attributes of the asset tags not copied to the inline tags
+INLINE_DROPPED_ATTRIBUTES = frozenset(("src", "href", "rel", "type", "integrity"))
+# Stylesheets referencing other resources relative to their own url
+RELATIVE_CSS = re.compile(r'url\s*\(|@import', re.IGNORECASE)
+# Inline scripts that can be served as external resources
+EXTRACTED_SCRIPT_TYPES = frozenset(("text/javascript", "application/javascript", "module"))
+EXTRACTED_NAME = re.compile(r'^[0-9a-f]{16}\.(?:js|css)$')
+EXTRACTED_CONTENT_TYPES = {
+    "js": "text/javascript; charset=utf-8",
+    "css": "text/css; charset=utf-8",
+}
+
+
+def parse_attributes(attributes):
+    """
+    Parse the attributes of a tag.
+    @param: attributes The attributes part of the tag
+    @return: dict of the lowercase attribute names and unquoted values
+    """
+    return {
+        name.lower(): value[1:-1] if value[:1] in ('"', "'") else value
+        for name, value in ATTRIBUTE.findall(attributes)
+    }
+
+
+def render_attributes(attributes, dropped=frozenset()):
+    """
+    Render parsed attributes back into the attributes part of a tag.
+    @param: attributes dict of attribute names and values, as parse_attributes returns
+    @param: dropped Names of the attributes left out (default: empty)
+    @return: The attributes, each with a leading space
+    """
+    rendered = []
+
+    for name, value in attributes.items():
+        if name in dropped:
+            continue
+
+        if value:
+            value = value.replace('"', "&quot;")
+            rendered.append(f' {name}="{value}"')
+        else:
+            rendered.append(f" {name}")
+
+    return "".join(rendered)
+
+
+class AssetInliner:
+    """
+    Inlines small scripts and stylesheets of the app static folder referenced
+    from HTML, minified with the JS and CSS pipeline of a Minify instance.
+    """
+
+    def __init__(self, minify, refresh_interval=1.0):
+        """
+        @param: minify The Minify instance, whose app serves the static files
+        @param: refresh_interval Minimum seconds between two checks of the assets
+        modification times in refresh (default: 1.0)
+        """
+        self.minify = minify
+        self.refresh_interval = refresh_interval
+        self.refreshed = 0.0
+        # (plan fingerprint, static file path) to its mtime and minified content
+        self.assets = {}
+
+    def _static_path(self, url):
+        """
+        Return the file path of a local static url, None for other urls.
+        @param: url The src or href of the asset
+        """
+        app = self.minify.app
+        if not url or app is None or app.static_folder is None:
+            return None
+
+        parts = urlsplit(url)
+        prefix = f"{app.static_url_path}/"
+        if parts.scheme or parts.netloc or not parts.path.startswith(prefix):
+            return None
+
+        return safe_join(app.static_folder, parts.path[len(prefix):])
+
+    def _read_minified(self, path, kind, plan):
+        """
+        Return the minified content of a static file, cached by its mtime.
+        @param: path The file path
+        @param: kind The content kind 'js' or 'css'
+        @param: plan The MinifyPlan to run
+        @return: Minified content, None when the file can not be inlined
+        """
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return None
+
+        key = (plan.fingerprint, path)
+        cached = self.assets.get(key)
+        if cached is not None and cached[0] == stat.st_mtime_ns:
+            return cached[1]
+
+        minified = None
+        if stat.st_size <= plan.inline_assets_limit:
+            with open(path, "rb") as asset:
+                content = asset.read()
+
+            closing = b"</script" if kind == "js" else b"</style"
+            if closing not in content.lower() and not (
+                kind == "css" and RELATIVE_CSS.search(content.decode("utf8"))
+            ):
+                minified = self.minify.store_minifed(kind, content, content, plan)
+
+        self.assets[key] = (stat.st_mtime_ns, minified)
+        return minified
+
+    def refresh(self):
+        """
+        Forget the assets modified or removed since they were read, checked at most
+        once per refresh_interval.
+        @return: Whether any asset changed
+        """
+        now = time.monotonic()
+        if now - self.refreshed < self.refresh_interval:
+            return False
+
+        self.refreshed = now
+        changed = False
+        mtimes = {}
+
+        for key, (mtime, minified) in list(self.assets.items()):
+            path = key[1]
+            if path not in mtimes:
+                try:
+                    mtimes[path] = os.stat(path).st_mtime_ns
+                except OSError:
+                    mtimes[path] = None
+
+            if mtimes[path] != mtime:
+                del self.assets[key]
+                changed = True
+
+        return changed
+
+    def _inline_tag(self, match, plan):
+        """
+        Return the inline replacement of a script or stylesheet tag, or None.
+        """
+        is_script = match.group(1) is not None
+        attributes = match.group(1 if is_script else 2)
+        if isinstance(attributes, bytes):
+            attributes = attributes.decode("utf8")
+        attributes = parse_attributes(attributes)
+
+        if is_script:
+            script_type = attributes.get("type", "text/javascript").lower()
+            if DEFERRED_SCRIPT & set(attributes) or script_type not in (
+                "text/javascript", "application/javascript"
+            ):
+                return None
+            path, kind = self._static_path(attributes.get("src")), "js"
+        else:
+            if attributes.get("rel", "").lower() != "stylesheet":
+                return None
+            path, kind = self._static_path(attributes.get("href")), "css"
+
+        minified = self._read_minified(path, kind, plan) if path else None
+        if minified is None:
+            return None
+
+        # Keeps nonce, id, media and the other attributes
+        kept = render_attributes(attributes, INLINE_DROPPED_ATTRIBUTES)
+        if is_script:
+            return f"<script{kept}>{minified}</script>"
+
+        return f"<style{kept}>{minified}</style>"
+
+    def inline(self, body, plan):
+        """
+        Replace references to small local scripts and stylesheets with their minified content.
+        @param: body The HTML document, str or UTF-8 bytes
+        @param: plan The MinifyPlan to run
+        @return: Document with the assets inlined, of the same type as body
+        """
+        pattern = ASSET_TAGS_PATTERNS[isinstance(body, bytes)]
+        replacements = []
+
+        for match in pattern.finditer(body):
+            try:
+                replacement = self._inline_tag(match, plan)
+            except Exception as e:
+                if self.minify.fail_safe:
+                    continue
+                else:
+                    raise e
+
+            if replacement is not None:
+                replacements.append(match.span() + (replacement,))
+
+        return self.minify._splice(body, replacements)
+
+
+class BlockExtractor:
+    """
+    Moves large minified inline scripts and styles out of HTML documents into
+    content hashed resources, served by a route of the app with immutable
+    cache headers, so browsers cache them across pages. The resources are
+    written to a private directory, so every worker process serves them, after
+    restarts too, and removed once no page extracted them for max_age seconds.
+    """
+
+    # Seconds between two removals of the unused resources
+    SWEEP_INTERVAL = 3600
+
+    def __init__(self, minify, url_path, directory=None, max_age=604800):
+        """
+        @param: minify The Minify instance
+        @param: url_path The url path the resources are served under
+        @param: directory The directory the resources are written to, None for
+        'minify_blocks' in the instance folder of the app (default: None)
+        @param: max_age Seconds after which the resources no page extracted are
+        removed, None to keep them (default: 604800, a week)
+        """
+        self.minify = minify
+        self.url_path = url_path.rstrip("/")
+        self.directory = directory
+        self.max_age = max_age
+        self.swept = None  # time of the last sweep
+        # Resource names to their content, read from the directory on misses
+        self.blocks = MinifyCache(
+            minify.cache_limit, minify.cache_shards, minify.cache_compress_after
+        )
+
+    def register(self, app):
+        """
+        Register the route serving the extracted resources.
+        @param: app The Quart app
+        """
+        if self.directory is None:
+            self.directory = os.path.join(app.instance_path, "minify_blocks")
+
+        app.add_url_rule(f"{self.url_path}/<name>", "minify_extracted", self.serve)
+
+    def _directory(self):
+        """
+        Return the directory of the resources, a private temporary one without an app.
+        """
+        if self.directory is None:
+            self.directory = tempfile.mkdtemp(prefix="quart_minify_blocks_")
+
+        return self.directory
+
+    def _store(self, name, data):
+        """
+        Write the content of a resource to the directory, once per process, and
+        refresh its modification time on the next extractions so it is not swept.
+        """
+        directory = self._directory()
+        path = os.path.join(directory, name)
+
+        if self.blocks.get(name) is not None:
+            try:
+                os.utime(path)
+                return
+            except OSError:
+                pass  # Swept by another worker, written again
+
+        os.makedirs(directory, mode=0o700, exist_ok=True)
+        # Written aside then renamed, so concurrent workers never serve a partial
+        # file, and a file planted under the name is replaced
+        descriptor, temporary = tempfile.mkstemp(dir=directory, suffix=".tmp")
+        try:
+            with os.fdopen(descriptor, "wb") as block:
+                block.write(data)
+            os.replace(temporary, path)
+        except Exception as e:
+            os.unlink(temporary)
+            raise e
+
+        self.blocks.set(name, data)
+
+        now = time.monotonic()
+        if self.swept is None or now - self.swept >= self.SWEEP_INTERVAL:
+            self.swept = now
+            self.sweep()
+
+    def sweep(self):
+        """
+        Remove the resources no page extracted for max_age seconds. Cached
+        responses may reference them, so they are cleared when any is removed.
+        @return: The number of removed resources
+        """
+        if self.max_age is None or self.directory is None:
+            return 0
+
+        removed = 0
+        oldest = time.time() - self.max_age
+
+        try:
+            names = os.listdir(self.directory)
+        except OSError:
+            return 0
+
+        for name in names:
+            if not EXTRACTED_NAME.match(name):
+                continue
+
+            path = os.path.join(self.directory, name)
+            try:
+                if os.stat(path).st_mtime >= oldest:
+                    continue
+                os.unlink(path)
+            except OSError:
+                continue
+
+            self.blocks.pop(name)
+            removed += 1
+
+        if removed:
+            self.minify.responses.clear()
+
+        return removed
+
+    def _load(self, name):
+        """
+        Return the content of a resource, None when it does not exist or its
+        content does not match its name.
+        """
+        data = self.blocks.get(name)
+        if data is not None or not EXTRACTED_NAME.match(name) or self.directory is None:
+            return data
+
+        try:
+            with open(os.path.join(self.directory, name), "rb") as block:
+                data = block.read()
+        except OSError:
+            return None
+
+        if md5(data).hexdigest()[:16] != name.split(".", 1)[0]:
+            return None
+
+        self.blocks.set(name, data)
+        return data
+
+    def extract(self, text, start, end, tag, minified):
+        """
+        Return the replacement of an inline tag by a reference to its extracted body.
+        @param: text The HTML text, str or UTF-8 bytes
+        @param: start The start offset of the tag body
+        @param: end The end offset of the tag body
+        @param: tag The tag name ('style' or 'script')
+        @param: minified The minified tag body
+        @return: (start, end, replacement) spanning the whole tag, None when it is kept inline
+        """
+        if PLACEHOLDER_PATTERN.search(minified):
+            # Volatile values are only put back into the response body
+            return None
+
+        opening = text.rfind(b"<" if isinstance(text, bytes) else "<", 0, start)
+        attributes = text[opening + len(tag) + 1:start - 1]
+        if isinstance(attributes, bytes):
+            attributes = attributes.decode("utf8")
+        attributes = parse_attributes(attributes)
+
+        if tag == "script" and (
+            "src" in attributes
+            or attributes.get("type", "text/javascript").lower() not in EXTRACTED_SCRIPT_TYPES
+        ):
+            return None
+
+        data = minified.encode("utf8")
+        extension = "js" if tag == "script" else "css"
+        name = f"{md5(data).hexdigest()[:16]}.{extension}"
+        url = f"{self.url_path}/{name}"
+        self._store(name, data)
+
+        # Keeps nonce, id, crossorigin, media, data-* and the other attributes
+        kept = render_attributes(attributes, ("type",))
+        if tag == "script":
+            module = ' type="module"' if attributes.get("type") == "module" else ""
+            replacement = f'<script src="{url}"{module}{kept}></script>'
+        else:
+            replacement = f'<link rel="stylesheet" href="{url}"{kept}>'
+
+        return opening, end + len(tag) + 3, replacement
+
+    async def serve(self, name):
+        data = self._load(name)
+        if data is None:
+            abort(404)
+
+        return Response(
+            data,
+            content_type=EXTRACTED_CONTENT_TYPES[name.rsplit(".", 1)[-1]],
+            headers={"Cache-Control": "public, max-age=31536000, immutable"},
+        )
@@ -0,0 +1,514 @@
+from collections import OrderedDict
+import threading
+import time
+import zlib
+
+# Entries smaller than this are not worth compressing
+COMPRESS_MIN_SIZE = 256
+
+
+class _Entry:
+    """
+    Cached value stored as UTF-8 bytes, zlib compressed once cold.
+    """
+
+    __slots__ = (
+        "data", "text", "compressed", "size", "hits", "created", "accessed", "expires",
+        "generation",
+    )
+
+    def __init__(self, value, now, expires, generation):
+        self.text = isinstance(value, str)
+        self.data = value.encode("utf8") if self.text else bytes(value)
+        self.compressed = False
+        self.size = len(self.data)
+        self.hits = 0
+        self.created = now
+        self.accessed = now
+        self.expires = expires  # time after which the entry is stale, or None
+        self.generation = generation  # generation of the cache it was stored in
+
+    def value(self):
+        """
+        Return the value, of the type it was stored with.
+        """
+        data = zlib.decompress(self.data) if self.compressed else self.data
+        return data.decode("utf8") if self.text else data
+
+    def compress(self):
+        """
+        Compress the data, when it is big enough and shrinks.
+        """
+        if self.compressed or self.size < COMPRESS_MIN_SIZE:
+            return
+
+        data = zlib.compress(self.data)
+        if len(data) < self.size:
+            self.data = data
+            self.compressed = True
+
+    def decompress(self):
+        if self.compressed:
+            self.data = zlib.decompress(self.data)
+            self.compressed = False
+
+
+class _Shard:
+    """
+    LRU entries of a part of the keys, guarded by their own lock.
+    """
+
+    __slots__ = (
+        "lock", "limit", "entries", "hits", "misses", "evictions", "expirations", "swept",
+    )
+
+    # Whether the entries are ordered by last hit
+    ordered = True
+
+    def __init__(self, limit):
+        self.lock = threading.Lock()
+        self.limit = limit
+        self.entries = OrderedDict()  # key to _Entry, least recently used first
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0  # stale entries removed when read
+        self.swept = 0.0  # time of the last compression sweep
+
+    def touch(self, key):
+        """
+        Record a hit of a key, lock held.
+        """
+        self.entries.move_to_end(key)
+
+    def store(self, key, entry):
+        """
+        Store an entry, evicting over the limit, lock held.
+        """
+        previous = self.entries.get(key)
+        if previous is not None:
+            entry.hits = previous.hits
+            entry.created = previous.created
+            self.touch(key)
+        elif self.limit < 1:
+            return
+        else:
+            self.evict(self.limit - 1)
+
+        self.entries[key] = entry
+
+    def remove(self, key):
+        """
+        Remove an entry, lock held.
+        @return: The removed _Entry or None
+        """
+        return self.entries.pop(key, None)
+
+    def clear(self):
+        self.entries.clear()
+
+    def evict(self, size):
+        """
+        Evict least recently used entries until at most size are left, lock held.
+        """
+        while self.entries and len(self.entries) > max(size, 0):
+            self.entries.popitem(last=False)
+            self.evictions += 1
+
+    def sweep(self, now, cold):
+        """
+        Compress the entries not read since cold, lock held. When the least
+        recently used entries come first, the sweep stops at the first warm one.
+        """
+        self.swept = now
+        for entry in self.entries.values():
+            if entry.accessed <= cold:
+                entry.compress()
+            elif self.ordered:
+                break
+
+
+class _S3FIFOShard(_Shard):
+    """
+    S3-FIFO entries: new keys enter a small FIFO queue, and only those hit
+    while in it move to the main queue, so scans of keys read once do not
+    flush the hot entries. Keys evicted from the small queue are remembered
+    in a ghost queue and enter the main queue when stored again. Entries of
+    the main queue hit since they were last examined are given another round.
+    """
+
+    __slots__ = ("small", "main", "ghost")
+
+    ordered = False
+    # Hits counted per entry in the queues
+    MAX_FREQUENCY = 3
+
+    def __init__(self, limit):
+        super().__init__(limit)
+        self.small = OrderedDict()  # keys to their hits, oldest first
+        self.main = OrderedDict()
+        self.ghost = OrderedDict()  # keys evicted from the small queue
+
+    def touch(self, key):
+        queue = self.small if key in self.small else self.main
+        queue[key] = min(queue[key] + 1, self.MAX_FREQUENCY)
+
+    def store(self, key, entry):
+        previous = self.entries.get(key)
+        if previous is not None:
+            entry.hits = previous.hits
+            entry.created = previous.created
+            self.touch(key)
+        elif self.limit < 1:
+            return
+        else:
+            self.evict(self.limit - 1)
+            if key in self.ghost:
+                del self.ghost[key]
+                self.main[key] = 0
+            else:
+                self.small[key] = 0
+
+        self.entries[key] = entry
+
+    def remove(self, key):
+        self.small.pop(key, None)
+        self.main.pop(key, None)
+        return self.entries.pop(key, None)
+
+    def clear(self):
+        self.entries.clear()
+        self.small.clear()
+        self.main.clear()
+        self.ghost.clear()
+
+    def evict(self, size):
+        small_limit = max(self.limit // 10, 1)
+
+        while self.entries and len(self.entries) > max(size, 0):
+            if self.small and (len(self.small) >= small_limit or not self.main):
+                key, frequency = self.small.popitem(last=False)
+                if frequency:
+                    self.main[key] = 0
+                    continue
+
+                self.ghost[key] = None
+                while len(self.ghost) > max(self.limit - small_limit, 1):
+                    self.ghost.popitem(last=False)
+            else:
+                key, frequency = self.main.popitem(last=False)
+                if frequency:
+                    self.main[key] = frequency - 1
+                    continue
+
+            del self.entries[key]
+            self.evictions += 1
+
+
+# Eviction policies, by name
+CACHE_POLICIES = {"lru": _Shard, "s3fifo": _S3FIFOShard}
+
+
+class MinifyCache:
+    """
+    Cache of minified content, evicting with LRU or S3-FIFO, keeping hit
+    counts per entry and statistics, with a runtime adjustable limit.
+    Values are kept as UTF-8 bytes in compact entries, optionally
+    compressed once cold. Entries go stale when their time to live is
+    over, or once the generation of the cache is bumped, and are removed
+    when read or evicted. Safe to share between threads: keys are spread
+    by hash over shards with their own lock and a share of the limit, the
+    eviction order is kept per shard.
+    """
+
+    def __init__(self, limit, shards=1, compress_after=None, policy="lru", ttl=None):
+        """
+        @param: limit Maximum number of entries to keep
+        @param: shards Number of independently locked shards, at most limit (default: 1)
+        @param: compress_after Seconds without hits after which entries are zlib
+        compressed, until their next hit, None to never compress (default: None)
+        @param: policy Eviction policy, 'lru' or the scan resistant 's3fifo',
+        keeping the entries hit more than once over keys read once (default: 'lru')
+        @param: ttl Seconds the entries are served for, None to keep them until
+        evicted (default: None)
+        """
+        if policy not in CACHE_POLICIES:
+            raise ValueError(f"unknown cache policy: {policy!r}")
+
+        self.policy = policy
+        self.compress_after = compress_after
+        self.ttl = ttl
+        self.generation = 0
+        self.shards = shards  # requested, the cache uses at most limit shards
+        self._shards = []
+        self.resize(limit)
+
+    def _shard(self, key):
+        shards = self._shards
+        return self._single or shards[hash(key) % len(shards)]
+
+    def __len__(self):
+        """
+        Return the number of entries held, stale ones included.
+        """
+        return sum(len(shard.entries) for shard in self._shards)
+
+    def __contains__(self, key):
+        entry = self._shard(key).entries.get(key)
+        return entry is not None and not self._stale(entry, time.monotonic())
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def _stale(self, entry, now):
+        return entry.generation != self.generation or (
+            entry.expires is not None and entry.expires <= now
+        )
+
+    def _entries(self):
+        """
+        Return a snapshot of the (key, entry) pairs of every shard, stale ones excluded.
+        """
+        now = time.monotonic()
+        entries = []
+        for shard in self._shards:
+            with shard.lock:
+                entries.extend(
+                    (key, entry) for key, entry in shard.entries.items()
+                    if not self._stale(entry, now)
+                )
+        return entries
+
+    def items(self):
+        return [(key, entry.value()) for key, entry in self._entries()]
+
+    def keys(self):
+        return [key for key, entry in self._entries()]
+
+    def values(self):
+        return [entry.value() for key, entry in self._entries()]
+
+    @property
+    def hits(self):
+        return sum(shard.hits for shard in self._shards)
+
+    @property
+    def misses(self):
+        return sum(shard.misses for shard in self._shards)
+
+    @property
+    def evictions(self):
+        return sum(shard.evictions for shard in self._shards)
+
+    @property
+    def expirations(self):
+        return sum(shard.expirations for shard in self._shards)
+
+    def bump(self):
+        """
+        Make every entry stale at once, without walking them. The stale entries
+        are removed when read, or evicted.
+        @return: The new generation
+        """
+        self.generation += 1
+        return self.generation
+
+    def get(self, key, default=None):
+        """
+        Return a cached value and mark it recently used.
+        @param: key The cache key
+        @param: default Value returned on a miss (default: None)
+        @return: The cached value, of the type it was stored with, or default
+        """
+        shards = self._shards  # one read, resize may replace them
+        shard = self._single or shards[hash(key) % len(shards)]
+        now = time.monotonic()
+
+        with shard.lock:
+            try:
+                entry = shard.entries[key]
+            except KeyError:
+                shard.misses += 1
+                return default
+
+            if entry.generation != self.generation or (
+                entry.expires is not None and entry.expires <= now
+            ):
+                shard.remove(key)
+                shard.expirations += 1
+                shard.misses += 1
+                return default
+
+            shard.touch(key)
+            entry.decompress()
+            entry.hits += 1
+            entry.accessed = now
+            shard.hits += 1
+            data = entry.data
+
+        return data.decode("utf8") if entry.text else data
+
+    def set(self, key, value, ttl=None):
+        """
+        Store a value, evicting entries over the limit.
+        @param: key The cache key
+        @param: value The value to store, str or bytes
+        @param: ttl Seconds the value is served for, None for the ttl of the cache (default: None)
+        """
+        shards = self._shards  # one read, resize may replace them
+        shard = self._single or shards[hash(key) % len(shards)]
+        now = time.monotonic()
+        ttl = self.ttl if ttl is None else ttl
+        entry = _Entry(value, now, None if ttl is None else now + ttl, self.generation)
+
+        with shard.lock:
+            shard.store(key, entry)
+
+            if self.compress_after is not None and now - shard.swept >= self.compress_after:
+                shard.sweep(now, now - self.compress_after)
+
+    def pop(self, key, default=None):
+        """
+        Remove an entry.
+        @param: key The cache key
+        @param: default Value returned when the key is not cached (default: None)
+        @return: The removed value or default
+        """
+        shard = self._shard(key)
+
+        with shard.lock:
+            entry = shard.remove(key)
+
+        if entry is None or self._stale(entry, time.monotonic()):
+            return default
+
+        return entry.value()
+
+    def resize(self, limit):
+        """
+        Change the limit, shared between the shards, evicting the entries over it.
+        The shards are rebuilt when there are more than the limit, or fewer than
+        requested, so none of them is left without room.
+        @param: limit The new maximum number of entries
+        """
+        self.limit = limit
+        count = max(min(self.shards, limit), 1)
+        if count != len(self._shards):
+            self._reshard(count)
+
+        count = len(self._shards)
+        for index, shard in enumerate(self._shards):
+            with shard.lock:
+                shard.limit = limit // count + (index < limit % count)
+                shard.evict(shard.limit)
+
+    def _reshard(self, count):
+        """
+        Replace the shards with count shards, moving the entries and statistics over.
+        Writes racing with it may be lost, like entries evicted early.
+        @param: count The number of shards
+        """
+        shards = [CACHE_POLICIES[self.policy](0) for _ in range(count)]
+        for index, shard in enumerate(shards):
+            shard.limit = self.limit // count + (index < self.limit % count)
+
+        for previous in self._shards:
+            with previous.lock:
+                for key, entry in previous.entries.items():
+                    shards[hash(key) % count].store(key, entry)
+
+                shards[0].hits += previous.hits
+                shards[0].misses += previous.misses
+                shards[0].evictions += previous.evictions
+                shards[0].expirations += previous.expirations
+
+        self._shards = shards
+        self._single = shards[0] if count == 1 else None
+
+    def clear(self):
+        for shard in self._shards:
+            with shard.lock:
+                shard.clear()
+
+    def compress(self, idle=0):
+        """
+        Compress the entries without hits for idle seconds, without waiting for a sweep.
+        @param: idle Seconds since the last hit of the compressed entries (default: 0)
+        """
+        now = time.monotonic()
+        for shard in self._shards:
+            with shard.lock:
+                shard.sweep(now, now - idle)
+
+    def invalidate(self, predicate):
+        """
+        Remove the entries matching a predicate.
+        @param: predicate Callable taking the key and value of an entry
+        @return: The number of removed entries
+        """
+        removed = 0
+
+        for shard in self._shards:
+            with shard.lock:
+                keys = [
+                    key for key, entry in shard.entries.items() if predicate(key, entry.value())
+                ]
+                for key in keys:
+                    shard.remove(key)
+                removed += len(keys)
+
+        return removed
+
+    def size(self):
+        """
+        Return the total UTF-8 size of the cached values.
+        """
+        return sum(entry.size for key, entry in self._entries())
+
+    def stats(self):
+        """
+        Return the cache statistics.
+        @return: dict of entries, stale (entries held until removed), limit, size,
+        stored (bytes held once compressed), compressed, hits, misses, hit_ratio,
+        evictions and expirations (stale entries removed when read)
+        """
+        held = len(self)
+        entries = [entry for key, entry in self._entries()]
+        hits, misses = self.hits, self.misses
+        lookups = hits + misses
+        return {
+            "entries": len(entries),
+            "stale": max(held - len(entries), 0),
+            "limit": self.limit,
+            "size": sum(entry.size for entry in entries),
+            "stored": sum(len(entry.data) for entry in entries),
+            "compressed": sum(entry.compressed for entry in entries),
+            "hits": hits,
+            "misses": misses,
+            "hit_ratio": hits / lookups if lookups else 0.0,
+            "evictions": self.evictions,
+            "expirations": self.expirations,
+        }
+
+    def top(self, count=10, by="size"):
+        """
+        Return the biggest or most hit entries.
+        @param: count The number of entries to return (default: 10)
+        @param: by Sort by 'size' or 'hits' (default: 'size')
+        @return: List of dicts with the key, size, hits, age and idle seconds of the entries
+        """
+        if by not in ("size", "hits"):
+            raise ValueError(f"can not sort cache entries by {by!r}")
+
+        now = time.monotonic()
+        entries = [
+            {
+                "key": key,
+                "size": entry.size,
+                "hits": entry.hits,
+                "age": now - entry.created,
+                "idle": now - entry.accessed,
+            }
+            for key, entry in self._entries()
+        ]
+        return sorted(entries, key=lambda entry: entry[by], reverse=True)[:count]
@@ -0,0 +1,131 @@
+from bisect import bisect_left
+from itertools import accumulate
+import re
+from zlib import crc32
+
+# Elements whose content is never cut nor collapsed, and comments
+PROTECTED = re.compile(
+    r'<(?=[sSpPtT!])(?:(script|style|pre|textarea)\b.*?</\1\s*>|!--.*?-->)',
+    re.DOTALL | re.IGNORECASE,
+)
+TOKEN = re.compile(
+    r'<(?:(script|style|pre|textarea)\b.*?</\1\s*>|!--.*?-->|(/?)([a-zA-Z][\w:-]*)[^>]*>)',
+    re.DOTALL | re.IGNORECASE,
+)
+# Start and end tags, quoted attribute values may hold '>'
+QUOTED_TAG = re.compile(r'<(?:/?[a-zA-Z][\w:-]*|!)(?:[^>"\']|"[^"]*"|\'[^\']*\')*>')
+VOID_ELEMENTS = frozenset((
+    "area", "base", "br", "col", "embed", "hr", "img", "input", "link", "meta", "param",
+    "source", "track", "wbr",
+))
+# Lines whose checksum has these bits unset start a new chunk, so the cuts only depend
+# on the content around them and an edit only changes its own chunk.
+BOUNDARY_MASK = 3
+# Text following every piece while it is minified, since end tags the engine
+# can omit at the end of a document may be needed in front of the next piece.
+SENTINEL = "qmchunkx"
+
+
+def outside_tag(text, start, position):
+    """
+    Tell whether an offset falls outside tags, unsure cases are not.
+    @param: text The HTML document
+    @param: start An offset known to fall outside tags, before position
+    @param: position The offset
+    """
+    opening = text.rfind("<", start, position)
+    if opening == -1:
+        return True
+
+    match = QUOTED_TAG.match(text, opening)
+    if match is None or match.end() > position:
+        return False
+
+    # A '<' quoted in an attribute value of a tag spanning the offset leaves a quote after it
+    tail = text[match.end():position]
+    return '"' not in tail and "'" not in tail
+
+
+def split_chunks(text, chunk_size):
+    """
+    Split an HTML document into chunks at content defined line starts,
+    outside tags, scripts, styles, pre, textarea and comments.
+    @param: text The HTML document
+    @param: chunk_size Minimum size of the chunks, chunks are always cut
+    past four times that size
+    @return: List of the chunks, joining into the document
+    """
+    max_size = chunk_size * 4
+    protected = [match.span() for match in PROTECTED.finditer(text)]
+    protected.append((len(text) + 1, len(text) + 1))
+    region = 0
+    lines = text.splitlines(keepends=True)
+    ends = list(accumulate(map(len, lines)))  # offsets of the line ends
+    chunks = []
+    start = 0
+    index = 0
+
+    while True:
+        # Only the lines starting past the minimum size are candidates
+        index = bisect_left(ends, start + chunk_size, index)
+        while index < len(lines) - 1:
+            position = ends[index]
+            index += 1
+            if position - start < max_size and crc32(lines[index].encode()) & BOUNDARY_MASK:
+                continue
+
+            while protected[region][1] <= position:
+                region += 1
+
+            # Not inside a tag spanning several lines, like '<a\n href=...>'
+            if position <= protected[region][0] and outside_tag(text, start, position):
+                chunks.append(text[start:position])
+                start = position
+                break
+        else:
+            chunks.append(text[start:])
+            return chunks
+
+
+def balanced_spans(chunk):
+    """
+    Split a chunk into balanced pieces and the tags left unmatched in it,
+    the end tags of elements opened before and the start tags of elements
+    closed after.
+    @param: chunk The HTML chunk
+    @return: List of (start, end, balanced) spans covering the chunk, in order
+    """
+    glue = []  # spans of the unmatched end tags
+    stack = []  # (start, end, name) of the open elements
+
+    for match in TOKEN.finditer(chunk):
+        if match.group(1) or match.group(0).endswith("/>"):
+            continue
+
+        name = match.group(3).lower()
+        if not match.group(2):
+            if name not in VOID_ELEMENTS:
+                stack.append((match.start(), match.end(), name))
+            continue
+
+        # End tags close the last element of their name, and the elements it holds
+        for index in range(len(stack) - 1, -1, -1):
+            if stack[index][2] == name:
+                del stack[index:]
+                break
+        else:
+            glue.append(match.span())
+
+    spans = []
+    position = 0
+
+    for start, end in sorted(glue + [(start, end) for start, end, name in stack]):
+        if start > position:
+            spans.append((position, start, True))
+        spans.append((start, end, False))
+        position = end
+
+    if position < len(chunk):
+        spans.append((position, len(chunk), True))
+
+    return spans
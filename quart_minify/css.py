@@ -0,0 +1,215 @@
+from collections import namedtuple
+from hashlib import md5
+import re
+
+UsedSelectors = namedtuple(
+    "UsedSelectors",
+    [
+        "tags",  # frozenset of the lowercase tag names of the document
+        "ids",  # frozenset of the ids of the document
+        "classes",  # frozenset of the classes of the document
+        "fingerprint",  # digest of the three sets, namespacing the pruned cache keys
+    ],
+)
+
+# Quoted attribute values may hold '>'
+START_TAG = re.compile(r'<([a-zA-Z][\w-]*)((?:[^>"\']|"[^"]*"|\'[^\']*\')*)>')
+ID_OR_CLASS = re.compile(
+    r'(?<![\w-])(id|class)\s*=\s*(?:"([^"]*)"|\'([^\']*)\'|([^\s>]+))', re.IGNORECASE
+)
+# Elements browsers create even when the document leaves them out
+IMPLIED_TAGS = frozenset(("html", "head", "body"))
+
+# At-rules holding rules, pruned recursively, other at-rules are kept as they are
+GROUPING_AT_RULES = frozenset(("media", "supports", "container", "layer", "document"))
+ATTRIBUTE_SELECTOR = re.compile(r'\[[^\]]*\]')
+# Pseudo-classes and pseudo-elements, with one level of nested parentheses
+PSEUDO_SELECTOR = re.compile(r'::?[\w-]+(?:\((?:[^()]|\([^()]*\))*\))?')
+COMBINATOR = re.compile(r'\s*[>+~]\s*|\s+')
+TYPE_SELECTOR = re.compile(r'[a-zA-Z][\w-]*')
+NAME_SELECTOR = re.compile(r'([.#])([^.#]+)')
+
+
+def collect_selectors(document, keep=()):
+    """
+    Collect the tag names, ids and classes present in an HTML document.
+    @param: document The HTML document, str or UTF-8 bytes
+    @param: keep Tag names, '#ids' and '.classes' to consider present, like
+    classes only added by scripts (default: ())
+    @return: UsedSelectors
+    """
+    if isinstance(document, bytes):
+        document = document.decode("utf8")
+
+    tags, ids, classes = set(IMPLIED_TAGS), set(), set()
+
+    for tag, attributes in START_TAG.findall(document):
+        tags.add(tag.lower())
+
+        for name, double, single, bare in ID_OR_CLASS.findall(attributes):
+            value = double or single or bare
+            if name.lower() == "id":
+                ids.add(value)
+            else:
+                classes.update(value.split())
+
+    if "table" in tags:
+        tags.add("tbody")
+
+    for name in keep:
+        if name[:1] == "#":
+            ids.add(name[1:])
+        elif name[:1] == ".":
+            classes.add(name[1:])
+        else:
+            tags.add(name.lower())
+
+    tags, ids, classes = frozenset(tags), frozenset(ids), frozenset(classes)
+    digest = md5(repr((sorted(tags), sorted(ids), sorted(classes))).encode("utf8"))
+    return UsedSelectors(tags, ids, classes, digest.hexdigest()[:8])
+
+
+def selector_may_match(selector, used):
+    """
+    Tell whether a complex selector may match an element of the document.
+    Attribute selectors, pseudo-classes and pseudo-elements are ignored, so
+    selectors only depending on them are kept.
+    @param: selector A selector without commas
+    @param: used The UsedSelectors of the document
+    """
+    if "\\" in selector:
+        # Escaped names are not parsed
+        return True
+
+    selector = PSEUDO_SELECTOR.sub("", ATTRIBUTE_SELECTOR.sub("", selector))
+
+    for compound in COMBINATOR.split(selector.strip()):
+        tag = TYPE_SELECTOR.match(compound)
+        if tag and tag.group(0).lower() not in used.tags:
+            return False
+
+        for prefix, name in NAME_SELECTOR.findall(compound):
+            if name not in (used.ids if prefix == "#" else used.classes):
+                return False
+
+    return True
+
+
+def _find_top_level(css, position, characters):
+    """
+    Return the index of the first of characters outside strings and comments, or -1.
+    """
+    length = len(css)
+
+    while position < length:
+        char = css[position]
+
+        if char in ('"', "'"):
+            position += 1
+            while position < length and css[position] != char:
+                position += 2 if css[position] == "\\" else 1
+        elif char == "/" and css.startswith("/*", position):
+            end = css.find("*/", position + 2)
+            if end == -1:
+                return -1
+            position = end + 1
+        elif char in characters:
+            return position
+
+        position += 1
+
+    return -1
+
+
+def _matching_brace(css, opening):
+    """
+    Return the index of the brace closing the block opened at opening, or -1.
+    """
+    depth = 0
+    position = opening
+
+    while position != -1:
+        if css[position] == "{":
+            depth += 1
+        else:
+            depth -= 1
+            if depth == 0:
+                return position
+
+        position = _find_top_level(css, position + 1, "{}")
+
+    return -1
+
+
+def _split_selectors(prelude):
+    """
+    Split a selector list on the commas outside parentheses and brackets.
+    """
+    selectors = []
+    depth = 0
+    start = 0
+
+    for index, char in enumerate(prelude):
+        if char in "([":
+            depth += 1
+        elif char in ")]":
+            depth -= 1
+        elif char == "," and depth == 0:
+            selectors.append(prelude[start:index])
+            start = index + 1
+
+    selectors.append(prelude[start:])
+    return selectors
+
+
+def prune_css(css, used):
+    """
+    Remove the selectors of a stylesheet that can not match the document,
+    and the rules left without selectors. Keyframes, font faces and other
+    at-rules not holding rules are kept.
+    @param: css The stylesheet
+    @param: used The UsedSelectors of the document
+    @return: The pruned stylesheet
+    """
+    parts = []
+    position = 0
+
+    while position < len(css):
+        opening = _find_top_level(css, position, "{;}")
+        if opening == -1 or css[opening] != "{":
+            # Statements like @import, and whatever can not be parsed, are kept
+            end = len(css) if opening == -1 else opening + 1
+            parts.append(css[position:end])
+            position = end
+            continue
+
+        closing = _matching_brace(css, opening)
+        if closing == -1:
+            parts.append(css[position:])
+            break
+
+        prelude = css[position:opening]
+        body = css[opening + 1:closing]
+        stripped = prelude.strip()
+
+        if stripped.startswith("@"):
+            name = re.match(r'@(?:-\w+-)?([\w-]*)', stripped).group(1).lower()
+            if name in GROUPING_AT_RULES:
+                pruned = prune_css(body, used)
+                if pruned.strip():
+                    parts.append(f"{prelude}{{{pruned}}}")
+            else:
+                parts.append(css[position:closing + 1])
+        elif "/*" in prelude:
+            parts.append(css[position:closing + 1])
+        else:
+            selectors = [
+                selector for selector in _split_selectors(prelude)
+                if selector_may_match(selector, used)
+            ]
+            if selectors:
+                parts.append(f"{','.join(selectors)}{{{body}}}")
+
+        position = closing + 1
+
+    return "".join(parts)
@@ -0,0 +1,228 @@
+from functools import lru_cache
+import importlib
+from importlib import metadata
+from importlib.util import find_spec
+from io import StringIO
+import time
+
+
+@lru_cache(maxsize=None)
+def library_version(distribution):
+    """
+    Return the installed version of a distribution.
+    @param: distribution The distribution name
+    @return: The version, None when it is not installed
+    """
+    try:
+        return metadata.version(distribution)
+    except metadata.PackageNotFoundError:
+        return None
+
+
+class Engine:
+    """
+    Base class of the minification engines used by Minify.
+    Engines are registered per content kind ('html', 'css' or 'js') and
+    expose the same sync and async interface, so the backend for a kind
+    can be swapped without touching the response pipeline.
+    """
+
+    name = None
+    kind = None
+    # Capability flags: whether an html engine minifies the content of
+    # inline <script> and <style> tags itself.
+    inline_js = False
+    inline_css = False
+    # Whether minify accepts UTF-8 bytes, otherwise the text is decoded first.
+    accepts_bytes = False
+    # Modules of the engine library, imported the first time the engine minifies
+    # rather than when quart_minify is imported.
+    modules = ()
+    # Distribution of the engine library, whose version namespaces the cache keys
+    distribution = None
+
+    @property
+    def version(self):
+        """
+        The installed version of the engine library, None when unknown.
+        """
+        return library_version(self.distribution) if self.distribution else None
+
+    def load(self):
+        """
+        Import the engine library ahead of the first minification.
+        """
+        for module in self.modules:
+            importlib.import_module(module)
+
+    def minify(self, text):
+        """
+        Minify text and return the result.
+        @param: text The content to minify
+        @return: Minified content
+        """
+        raise NotImplementedError
+
+    async def minify_async(self, text):
+        """
+        Awaitable version of minify, engines without native async
+        support run the sync implementation.
+        @param: text The content to minify
+        @return: Minified content
+        """
+        return self.minify(text)
+
+    def __repr__(self):
+        return f"<{self.__class__.__name__} {self.kind}:{self.name}>"
+
+
+def minify_batch(engine, texts, prepare=None, timed=False):
+    """
+    Minify a batch of texts with an engine, in a single executor call. A module
+    level function, so process pools can pickle it along with the engine.
+    @param: engine The Engine instance
+    @param: texts List of the contents to minify, str or UTF-8 bytes
+    @param: prepare Picklable callable transforming the decoded contents first (default: None)
+    @param: timed Return the seconds spent on each content along with it (default: False)
+    @return: List of the minified contents, or of the exceptions they raised, in
+    (result, seconds) pairs when timed
+    """
+    results = []
+
+    for text in texts:
+        started = time.perf_counter()
+        try:
+            if isinstance(text, bytes):
+                text = text.decode("utf8")
+            if prepare is not None:
+                text = prepare(text)
+            result = engine.minify(text)
+        except Exception as e:
+            result = e
+
+        results.append((result, time.perf_counter() - started) if timed else result)
+
+    return results
+
+
+ENGINES = {"html": {}, "css": {}, "js": {}}
+DEFAULT_ENGINES = {"html": "minify_html_onepass", "css": "lesscpy", "js": "rjsmin"}
+
+
+def register_engine(engine_class):
+    """
+    Register an engine class under its kind and name, usable as a decorator.
+    @param: engine_class Engine subclass with name and kind set
+    @return: The registered engine class
+    """
+    if engine_class.kind not in ENGINES:
+        raise ValueError(f"unknown engine kind: {engine_class.kind!r}")
+
+    ENGINES[engine_class.kind][engine_class.name] = engine_class
+    return engine_class
+
+
+def get_engine(kind, engine=None):
+    """
+    Resolve an engine for a content kind.
+    @param: kind The content kind ('html', 'css' or 'js')
+    @param: engine Registered engine name, Engine instance or None for the default
+    @return: Engine instance
+    """
+    if isinstance(engine, Engine):
+        if engine.kind != kind:
+            raise ValueError(f"{engine!r} can not minify {kind}")
+        return engine
+
+    name = engine or DEFAULT_ENGINES[kind]
+    try:
+        return ENGINES[kind][name]()
+    except KeyError:
+        raise ValueError(f"no {kind} engine registered as {name!r}")
+
+
+def resolve_engines(engines=None):
+    """
+    Resolve the engine of every kind, falling back to the defaults.
+    @param: engines Mapping of kind to engine name or instance (default: None)
+    @return: dict of kind to Engine instance
+    """
+    engines = engines or {}
+    unknown = set(engines) - set(ENGINES)
+    if unknown:
+        raise ValueError(f"unknown engine kinds: {', '.join(sorted(unknown))}")
+
+    return {kind: get_engine(kind, engines.get(kind)) for kind in ENGINES}
+
+
+@register_engine
+class MinifyHtmlOnepassEngine(Engine):
+    name = "minify_html_onepass"
+    kind = "html"
+    modules = ("minify_html_onepass",)
+    distribution = "minify-html-onepass"
+
+    def minify(self, text):
+        import minify_html_onepass
+
+        return minify_html_onepass.minify(text, minify_js=False, minify_css=False)
+
+
+@register_engine
+class MinifyHtmlEngine(Engine):
+    """
+    minify_html engine, optionally minifying inline JS and CSS natively
+    in the same pass. Requires the optional minify-html package.
+    """
+
+    name = "minify_html"
+    kind = "html"
+    modules = ("minify_html",)
+    distribution = "minify-html"
+
+    def __init__(self, minify_js=False, minify_css=False, **options):
+        """
+        @param: minify_js Minify inline <script> content natively (default: False)
+        @param: minify_css Minify inline <style> content natively (default: False)
+        @param: options Extra keyword arguments passed to minify_html.minify
+        """
+        if find_spec("minify_html") is None:
+            raise ImportError("the minify_html engine requires: pip install minify-html")
+
+        self.inline_js = minify_js
+        self.inline_css = minify_css
+        self.options = options
+
+    def minify(self, text):
+        import minify_html
+
+        return minify_html.minify(
+            text, minify_js=self.inline_js, minify_css=self.inline_css, **self.options
+        )
+
+
+@register_engine
+class LesscpyEngine(Engine):
+    name = "lesscpy"
+    kind = "css"
+    # lesscpy defers loading its PLY based parser to the first compile
+    modules = ("lesscpy", "lesscpy.lessc.parser", "lesscpy.lessc.formatter")
+    distribution = "lesscpy"
+
+    def minify(self, text):
+        from lesscpy import compile
+
+        return compile(StringIO(text), minify=True, xminify=True)
+
+
+@register_engine
+class RJSMinEngine(Engine):
+    name = "rjsmin"
+    kind = "js"
+    modules = ("rjsmin",)
+    distribution = "rjsmin"
+
+    def minify(self, text):
+        import rjsmin
+
+        return rjsmin.jsmin(text)
@@ -0,0 +1,190 @@
+import re
+
+from jinja2 import BaseLoader, nodes
+from jinja2.ext import Extension
+from markupsafe import Markup
+from quart import current_app
+
+from quart_minify.chunks import SENTINEL
+
+# Jinja expressions, statements and comments
+JINJA_SYNTAX = re.compile(r"{{.*?}}|{%.*?%}|{#.*?#}", re.DOTALL)
+# Lowercase alphanumeric, so it passes as text, attribute name or value,
+# JavaScript identifier and CSS ident through every minifier unchanged.
+PLACEHOLDER = "qmjinja{}x"
+PLACEHOLDER_PATTERN = re.compile(r"qmjinja(\d+)x")
+# Attribute values the HTML minifier unquoted that hold a placeholder are quoted
+# again, since the rendered value may need quotes.
+START_TAG = re.compile(r"<[a-zA-Z][^<>]*qmjinja\d+x[^<>]*>")
+UNQUOTED_PLACEHOLDER = re.compile(r"(?<=[^\s\"'=<>`]=)([^\s\"'=<>`]*qmjinja\d+x[^\s\"'<>`]*)")
+# Extensions of the templates minified at load time, like select_autoescape
+HTML_TEMPLATE_EXTENSIONS = (".html", ".htm", ".jinja")
+
+
+def is_html_template(name):
+    """
+    Tell whether a template is HTML by its extension.
+    @param: name The template name
+    """
+    return name.lower().endswith(HTML_TEMPLATE_EXTENSIONS)
+
+
+def protect_jinja(source):
+    """
+    Replace Jinja syntax in a template source with placeholders.
+    @param: source The template source
+    @return: Tuple of the protected source and the replaced Jinja snippets
+    """
+    snippets = []
+
+    def to_placeholder(match):
+        snippets.append(match.group(0))
+        return PLACEHOLDER.format(len(snippets) - 1)
+
+    return JINJA_SYNTAX.sub(to_placeholder, source), snippets
+
+
+def quote_placeholders(source):
+    """
+    Quote the attribute values holding a placeholder the HTML minifier unquoted.
+    @param: source The minified source
+    @return: Source with the attribute values quoted
+    """
+    return START_TAG.sub(
+        lambda match: UNQUOTED_PLACEHOLDER.sub(r'"\1"', match.group(0)), source
+    )
+
+
+def restore_jinja(source, snippets):
+    """
+    Put the Jinja snippets replaced by protect_jinja back into a minified source.
+    @param: source The minified protected source
+    @param: snippets The snippets returned by protect_jinja
+    @return: Template source with Jinja syntax restored
+    """
+    return PLACEHOLDER_PATTERN.sub(
+        lambda match: snippets[int(match.group(1))], quote_placeholders(source)
+    )
+
+
+def strip_sentinel(minified):
+    """
+    Remove the SENTINEL following an HTML fragment minified as part of a bigger document.
+    @param: minified The minified fragment, followed by SENTINEL
+    @return: The minified fragment
+    """
+    if not minified.endswith(SENTINEL):
+        raise ValueError("the html engine did not keep the end of the fragment")
+
+    return minified[:-len(SENTINEL)]
+
+
+class MinifyingLoader(BaseLoader):
+    """
+    Jinja loader wrapping the app loader to minify HTML templates once, when
+    their source is loaded, with the Jinja syntax left untouched.
+    """
+
+    def __init__(self, loader, minify):
+        """
+        @param: loader The wrapped Jinja loader
+        @param: minify Minify instance whose pipeline minifies the templates
+        """
+        self.loader = loader
+        self.minify = minify
+        # Predicate on the template names to minify
+        self.select = (
+            minify.minify_templates if callable(minify.minify_templates) else is_html_template
+        )
+
+    def get_source(self, environment, template):
+        source, filename, uptodate = self.loader.get_source(environment, template)
+
+        if not self.select(template):
+            # Text, XML and other templates the HTML minifier would rewrite
+            return source, filename, uptodate
+
+        if PLACEHOLDER_PATTERN.search(source):
+            # Can not be told apart from the placeholders
+            return source, filename, uptodate
+
+        protected, snippets = protect_jinja(source)
+        # Rendering adds tags, ids and classes, styles are not pruned at load time,
+        # nor extracted, as templates outlive the extracted blocks cache.
+        plan = self.minify.plan._replace(prune_css=False, extract_min_size=0)
+        try:
+            # Included, imported and extended templates are followed by more markup,
+            # so their end tags are kept
+            minified = strip_sentinel(self.minify._minify_document(protected + SENTINEL, plan))
+            minified = restore_jinja(minified, snippets)
+        except Exception as e:
+            if self.minify.fail_safe:
+                return source, filename, uptodate
+            else:
+                raise e
+
+        self.minify.minified_templates.add(template)
+        return minified, filename, uptodate
+
+    def list_templates(self):
+        return self.loader.list_templates()
+
+
+class MinifyExtension(Extension):
+    """
+    Jinja extension minifying the enclosed block, cached by the digest of
+    the rendered block through the Minify instance of the current app.
+
+        {% minify %}<p>  html  </p>{% endminify %}
+        {% minify "js" %}var  x = 1;{% endminify %}
+        {% minify "css" %}body { color: red; }{% endminify %}
+    """
+
+    tags = {"minify"}
+
+    def parse(self, parser):
+        lineno = next(parser.stream).lineno
+
+        if parser.stream.current.type == "block_end":
+            kind = nodes.Const("html")
+        else:
+            kind = parser.parse_expression()
+
+        body = parser.parse_statements(("name:endminify",), drop_needle=True)
+        return nodes.CallBlock(
+            self.call_method("_minify_block", [kind]), [], [], body
+        ).set_lineno(lineno)
+
+    def _minify_block(self, kind, caller):
+        if self.environment.is_async:
+            return self._minify_block_async(kind, caller)
+
+        return self._minify_rendered(kind, caller())
+
+    async def _minify_block_async(self, kind, caller):
+        return self._minify_rendered(kind, await caller())
+
+    def _minify_rendered(self, kind, rendered):
+        """
+        Minify a rendered block with the Minify instance of the current app.
+        @param: kind The content kind 'html', 'js' or 'css'
+        @param: rendered The rendered block
+        @return: Minified block, marked safe when the rendered block was
+        """
+        minify = current_app.extensions["minify"]
+        text = str(rendered)
+        if kind == "html":
+            # Followed by the rest of the page, end tags at the end of the block are kept
+            text += SENTINEL
+
+        try:
+            minified = minify.store_minifed(kind, text, text)
+            if kind == "html":
+                minified = strip_sentinel(minified)
+        except Exception as e:
+            if minify.fail_safe:
+                return rendered
+            else:
+                raise e
+
+        return Markup(minified) if isinstance(rendered, Markup) else minified
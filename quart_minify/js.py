@@ -0,0 +1,178 @@
+import re
+
+ARROW_BEFORE = re.compile(r'(=>)\s*$')
+STATEMENT_END = re.compile(r'^\s*;?\s*')
+
+
+def _balanced_parens_end(text, start_pos):
+    """
+    Helper to find and remove text with balanced parentheses.
+    @param: text The text to search in
+    @param: start_pos Position of opening parenthesis
+    @return: End position of closing parenthesis, or -1 if not found
+    """
+    depth = 0
+    in_string = False
+    string_char = None
+    escape_next = False
+
+    for i in range(start_pos, len(text)):
+        char = text[i]
+
+        if escape_next:
+            escape_next = False
+            continue
+
+        if char == '\\':
+            escape_next = True
+            continue
+
+        if char in ('"', "'", '`') and not in_string:
+            in_string = True
+            string_char = char
+            continue
+
+        if in_string:
+            if char == string_char:
+                in_string = False
+                string_char = None
+            continue
+
+        if char == '(':
+            depth += 1
+        elif char == ')':
+            depth -= 1
+            if depth == 0:
+                return i
+
+    return -1
+
+
+def remove_comments(js_code):
+    """
+    Remove single-line (//) and multi-line (/* */) comments from JavaScript.
+    Preserves comments inside strings and regex patterns.
+    @param: js_code JavaScript code to process
+    @return: JavaScript code with comments removed
+    """
+    result = []
+    i = 0
+    length = len(js_code)
+    in_string = False
+    string_char = None
+    in_regex = False
+    escape_next = False
+
+    while i < length:
+        char = js_code[i]
+
+        if escape_next:
+            result.append(char)
+            escape_next = False
+            i += 1
+            continue
+
+        if char == '\\' and (in_string or in_regex):
+            result.append(char)
+            escape_next = True
+            i += 1
+            continue
+
+        if char in ('"', "'", '`') and not in_regex:
+            if not in_string:
+                in_string = True
+                string_char = char
+            elif char == string_char:
+                in_string = False
+                string_char = None
+            result.append(char)
+            i += 1
+            continue
+
+        if in_string or in_regex:
+            result.append(char)
+            i += 1
+            continue
+
+        if i + 1 < length and char == '/' and js_code[i + 1] == '/':
+            while i < length and js_code[i] not in ('\n', '\r'):
+                i += 1
+            if i < length:
+                result.append(js_code[i])
+                i += 1
+            continue
+
+        if i + 1 < length and char == '/' and js_code[i + 1] == '*':
+            i += 2
+            while i + 1 < length:
+                if js_code[i] == '*' and js_code[i + 1] == '/':
+                    i += 2
+                    break
+                i += 1
+            result.append(' ')
+            continue
+
+        result.append(char)
+        i += 1
+
+    return ''.join(result)
+
+
+def remove_console_statements(js_code, pattern):
+    """
+    Remove console statements from JavaScript code.
+    Uses improved parsing to handle nested parentheses and strings correctly.
+    @param: js_code JavaScript code to process
+    @param: pattern Compiled pattern of the console calls to remove, or None
+    @return: JavaScript code with console statements removed
+    """
+    if pattern is None:
+        return js_code
+
+    result = js_code
+    offset = 0
+
+    while True:
+        match = pattern.search(result, offset)
+        if not match:
+            break
+
+        abs_start = match.start()
+        paren_start = match.end() - 1
+
+        paren_end = _balanced_parens_end(result, paren_start)
+
+        if paren_end == -1:
+            offset = paren_start + 1
+            continue
+
+        before = result[:abs_start]
+        after = STATEMENT_END.sub('', result[paren_end + 1:], count=1)
+
+        if ARROW_BEFORE.search(before, max(len(before) - 30, 0)):
+            result = before + '{}' + after
+        else:
+            result = before + after
+
+        offset = abs_start
+
+    return result
+
+
+def prepare_js(js_code, console_pattern=None, debugger_pattern=None):
+    """
+    Apply the Python-level JavaScript transforms ahead of the js engine. A module
+    level function, so process pools can pickle it.
+    @param: js_code JavaScript code, str or UTF-8 bytes
+    @param: console_pattern Compiled pattern of the console calls to remove (default: None)
+    @param: debugger_pattern Compiled pattern of the debugger statements to remove (default: None)
+    @return: JavaScript code ready for the js engine
+    """
+    if isinstance(js_code, bytes):
+        js_code = js_code.decode("utf8")
+
+    js_code = remove_console_statements(remove_comments(js_code), console_pattern)
+    if debugger_pattern is not None:
+        js_code = debugger_pattern.sub('', js_code)
+
+    return js_code
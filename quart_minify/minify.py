@@ -1,13 +1,28 @@
 import asyncio
+from functools import partial
 from hashlib import md5
-from io import StringIO
-import re
-from collections import OrderedDict
+import time
+from collections import Counter
 
-import minify_html_onepass
-import rjsmin
-from lesscpy import compile
-from quart import request
+from quart import current_app, g, has_request_context, request, template_rendered
+
+from quart_minify.assets import AssetInliner, BlockExtractor
+from quart_minify.cache import MinifyCache
+from quart_minify.chunks import SENTINEL, balanced_spans, split_chunks
+from quart_minify.css import collect_selectors, prune_css
+from quart_minify.engines import minify_batch, resolve_engines
+from quart_minify.jinja import MinifyingLoader, quote_placeholders
+from quart_minify.js import prepare_js, remove_comments, remove_console_statements
+from quart_minify.plan import build_plan, compile_tag_pattern
+from quart_minify.profiler import FragmentProfiler
+from quart_minify.tokens import fill_tokens, normalize_tokens
+
+
+def as_text(text):
+    """
+    Return a text as str, decoding UTF-8 bytes.
+    """
+    return text.decode("utf8") if isinstance(text, bytes) else text
 
 
 class Minify:
@@ -23,7 +38,35 @@ class Minify:
         remove_console=False,
         console_types=('log', 'warn', 'error'),
         remove_debugger=False,
-        cache_limit=100
+        cache_limit=100,
+        engines=None,
+        native=False,
+        minify_templates=False,
+        executor=None,
+        stale_while_revalidate=False,
+        background_limit=100,
+        warm_up=False,
+        warm_up_concurrency=4,
+        profiles=None,
+        inline_assets=False,
+        inline_assets_limit=4096,
+        prune_css=False,
+        prune_css_keep=(),
+        extract_blocks=False,
+        extract_min_size=1024,
+        extract_url_path="/_minify/blocks",
+        extract_dir=None,
+        extract_max_age=604800,
+        chunked=False,
+        chunk_size=2048,
+        volatile_tokens=(),
+        cache_shards=1,
+        cache_compress_after=None,
+        cache_policy="lru",
+        cache_ttl=None,
+        executor_batch_size=8192,
+        profile_fragments=False,
+        profile_size=20
     ):
         """
         A Quart extension to minify flask response for html,
@@ -38,6 +81,63 @@ class Minify:
         @param: console_types Tuple of console types to remove: 'log', 'warn', 'error' (default: ('log', 'warn', 'error'))
         @param: remove_debugger Remove debugger statements from JavaScript (default: False)
         @param: cache_limit Maximum number of items to keep in cache (default: 100)
+        @param: engines Mapping of 'html', 'css' or 'js' to a registered engine name
+        or Engine instance, unset kinds use the defaults (default: None)
+        @param: native Minify HTML, inline CSS and JS in a single minify_html call
+        when no Python-only transforms are enabled, LESS is not compiled (default: False)
+        @param: minify_templates Minify Jinja templates once when they are loaded, responses
+        rendered only from minified templates skip the after request pass. True minifies
+        the .html, .htm and .jinja templates, a callable taking the template name selects
+        them (default: False)
+        @param: executor concurrent.futures executor the engines run on, instead of
+        the event loop (default: None)
+        @param: stale_while_revalidate Send responses missing the cache unminified and
+        minify them in a background task for the next requests, requires cache
+        (default: False)
+        @param: background_limit Maximum number of pending background minifications (default: 100)
+        @param: warm_up Render the GET routes without parameters when True, or a list of
+        urls, before serving to fill the caches (default: False)
+        @param: warm_up_concurrency Maximum number of urls rendered at once by warm up (default: 4)
+        @param: profiles Mapping of profile names to the options they override, or None to
+        disable minification, attached to routes with use_profile (default: None)
+        @param: inline_assets Inline the scripts and stylesheets of the static folder
+        referenced from HTML, minified, when small enough (default: False)
+        @param: inline_assets_limit Maximum size in bytes of the inlined assets (default: 4096)
+        @param: prune_css Remove the selectors of inline styles matching no tag name, id or
+        class of the document (default: False)
+        @param: prune_css_keep Tag names, '#ids' and '.classes' pruning considers present,
+        like classes added by scripts (default: ())
+        @param: extract_blocks Serve large inline scripts and styles as content hashed
+        resources with immutable cache headers, referenced from HTML (default: False)
+        @param: extract_min_size Minimum size in bytes of the extracted blocks (default: 1024)
+        @param: extract_url_path Url path the extracted blocks are served under
+        (default: '/_minify/blocks')
+        @param: extract_dir Directory the extracted blocks are written to, shared by the
+        worker processes, None for 'minify_blocks' in the instance folder of the app
+        (default: None)
+        @param: extract_max_age Seconds after which the blocks no page extracted are
+        removed, None to keep them (default: 604800, a week)
+        @param: chunked Minify HTML in balanced chunks cut at content defined tag edges,
+        cached by digest, so pages differing in small regions reuse most of their
+        minified chunks (default: False)
+        @param: chunk_size Minimum size in characters of the chunks (default: 2048)
+        @param: volatile_tokens Patterns of per request values, like VOLATILE_TOKENS for CSP
+        nonces and CSRF tokens, whose first group is replaced by a placeholder before the
+        response cache lookup and put back in the minified body (default: ())
+        @param: cache_shards Number of independently locked shards of each cache, for
+        minification running in threads, the LRU order is kept per shard (default: 1)
+        @param: cache_compress_after Seconds without hits after which cached values are zlib
+        compressed, until their next hit, None to never compress (default: None)
+        @param: cache_policy Eviction policy of the fragment and response caches, 'lru' or
+        's3fifo', which keeps the fragments shared by many pages when crawlers scan
+        pages read once (default: 'lru')
+        @param: cache_ttl Seconds the minified fragments and responses are served from the
+        caches, None to keep them until evicted (default: None)
+        @param: executor_batch_size Minimum size in characters of the batches of fragments
+        of a response missing the cache, sent together to the executor (default: 8192)
+        @param: profile_fragments Time the minification of every fragment and keep the
+        slowest and largest in a report, see profile_report (default: False)
+        @param: profile_size Number of fragments kept in each list of the report (default: 20)
         """
         self.app = app
         self.html = html
@@ -50,9 +150,52 @@ class Minify:
         self.console_types = console_types
         self.remove_debugger = remove_debugger
         self.cache_limit = cache_limit
-        # Use OrderedDict for LRU cache implementation
-        self.history = OrderedDict()  # where cache hash and compiled response stored
-        self.hashes = OrderedDict()  # where the hashes and text will be stored
+        self.cache_shards = cache_shards
+        self.cache_compress_after = cache_compress_after
+        self.cache_policy = cache_policy
+        self.cache_ttl = cache_ttl
+        self.engines = resolve_engines(engines)
+        self.native = native
+        self.minify_templates = minify_templates
+        self.minified_templates = set()  # names of the templates minified at load time
+        self.executor = executor
+        self.executor_batch_size = executor_batch_size
+        self.metrics = Counter()  # computed and coalesced fragment minifications
+        self.profiler = FragmentProfiler(profile_size) if profile_fragments else None
+        self._inflight = {}  # cache keys of fragments being minified and their futures
+        self.stale_while_revalidate = stale_while_revalidate
+        self.background_limit = background_limit
+        self._pending = set()  # digests of the responses minified in background tasks
+        self.warm_up_urls = warm_up
+        self.warm_up_concurrency = warm_up_concurrency
+        self.warm_up_report = None
+        self.profiles = dict(profiles or {})
+        # Blueprints, endpoints and path prefixes the profiles are attached to
+        self.profile_rules = {"endpoint": {}, "blueprint": {}, "path_prefix": {}}
+        self._route_plans = {}  # memoized plans by (endpoint, url rule)
+        self.inline_assets = inline_assets
+        self.inline_assets_limit = inline_assets_limit
+        self.asset_inliner = AssetInliner(self)
+        self.prune_css = prune_css
+        self.prune_css_keep = prune_css_keep
+        self.extract_blocks = extract_blocks
+        self.extract_min_size = extract_min_size
+        self.block_extractor = BlockExtractor(
+            self, extract_url_path, extract_dir, extract_max_age
+        )
+        self.chunked = chunked
+        self.chunk_size = chunk_size
+        self.volatile_tokens = volatile_tokens
+        # where cache hash and compiled response stored
+        self.history = MinifyCache(
+            cache_limit, cache_shards, cache_compress_after, cache_policy, cache_ttl
+        )
+        # where the hashes and text will be stored
+        self.hashes = MinifyCache(cache_limit, cache_shards)
+        # body digests and minified bodies
+        self.responses = MinifyCache(
+            cache_limit, cache_shards, cache_compress_after, cache_policy, cache_ttl
+        )
 
         # Validate boolean parameters without using eval() (security fix)
         bool_params = {
@@ -61,281 +204,1188 @@ class Minify:
             'html': html,
             'cache': cache,
             'remove_console': remove_console,
-            'remove_debugger': remove_debugger
+            'remove_debugger': remove_debugger,
+            'native': native,
+            'stale_while_revalidate': stale_while_revalidate,
+            'inline_assets': inline_assets,
+            'prune_css': prune_css,
+            'extract_blocks': extract_blocks,
+            'chunked': chunked
         }
         for param_name, param_value in bool_params.items():
             if not isinstance(param_value, bool):
                 raise TypeError(f"minify({param_name}=) requires True or False")
 
+        if not (isinstance(minify_templates, bool) or callable(minify_templates)):
+            raise TypeError("minify(minify_templates=) requires True, False or a callable")
+
+        if stale_while_revalidate and not cache:
+            # The background minifications would be dropped, no response would be minified
+            raise ValueError("minify(stale_while_revalidate=True) requires cache=True")
+
+        self.compile_plan()
+        self.native_engine = self.plan.native_engine
+
         if self.app:
             self.init_app(self.app)
 
     def init_app(self, app):
         self.app = app
+        self.compile_plan()
+        self.app.extensions["minify"] = self
         self.app.after_request(self.to_loop_tag)
 
-    def _evict_lru_cache(self, cache_dict):
+        if self.extract_blocks or any(
+            overrides and overrides.get("extract_blocks") for overrides in self.profiles.values()
+        ):
+            self.block_extractor.register(app)
+
+        if self.minify_templates:
+            app.jinja_env.loader = MinifyingLoader(app.jinja_env.loader, self)
+            template_rendered.connect(self._template_rendered, app, weak=False)
+
+        if self.warm_up_urls:
+            self.load_engines()
+            self.app.before_serving(self._warm_up_before_serving)
+
+    def compile_plan(self):
         """
-        Evict least recently used item from cache if limit is reached.
-        @param: cache_dict The cache dictionary to evict from
+        Compile the options into the immutable plan the response pipeline runs,
+        call again after changing options of an initialized instance.
+        @return: MinifyPlan
         """
-        if len(cache_dict) >= self.cache_limit:
-            # Remove oldest (least recently used) item
-            cache_dict.popitem(last=False)
+        self.plan = build_plan(self)
+        self.profile_plans = {
+            name: None if overrides is None else build_plan(self, name, overrides)
+            for name, overrides in self.profiles.items()
+        }
+        self._route_plans.clear()
+        return self.plan
 
-    def get_hashed(self, text):
+    def use_profile(self, name, blueprint=None, endpoint=None, path_prefix=None):
         """
-        Return text hashed and store it in hashes with LRU eviction.
-        @param: text The text to hash
-        @return: The hash string
+        Attach a profile to a blueprint, an endpoint or the url rules under a path prefix.
+        Endpoints take precedence over blueprints, and blueprints over path prefixes.
+        @param: name The profile name, a key of profiles
+        @param: blueprint Name of the blueprint the profile applies to
+        @param: endpoint Name of the endpoint the profile applies to
+        @param: path_prefix Path prefix of the url rules the profile applies to, matched
+        on whole path segments
+        """
+        if name not in self.profiles:
+            raise ValueError(f"unknown minify profile: {name!r}")
+
+        for scope, value in (
+            ("endpoint", endpoint),
+            ("blueprint", blueprint),
+            ("path_prefix", path_prefix),
+        ):
+            if value is not None:
+                self.profile_rules[scope][value] = name
+
+        self._route_plans.clear()
+
+    def _resolve_profile(self, endpoint, rule):
         """
-        if text in self.hashes:
-            self.hashes.move_to_end(text)
-            return self.hashes[text]
+        Return the name of the profile attached to a route, or None.
+        @param: endpoint The endpoint of the route
+        @param: rule The url rule of the route
+        """
+        if endpoint in self.profile_rules["endpoint"]:
+            return self.profile_rules["endpoint"][endpoint]
+
+        # Most nested blueprint first, for endpoints like 'parent.child.view'
+        blueprints = endpoint.split(".")[:-1] if endpoint else []
+        for index in range(len(blueprints), 0, -1):
+            blueprint = ".".join(blueprints[:index])
+            if blueprint in self.profile_rules["blueprint"]:
+                return self.profile_rules["blueprint"][blueprint]
+
+        if rule is not None:
+            # Matched on a path segment boundary, '/api' does not match '/apis'
+            prefixes = [
+                prefix
+                for prefix in self.profile_rules["path_prefix"]
+                if rule == prefix or rule.startswith(prefix.rstrip("/") + "/")
+            ]
+            if prefixes:
+                return self.profile_rules["path_prefix"][max(prefixes, key=len)]
+
+        return None
+
+    def _route_plan(self):
+        """
+        Return the plan of the current request, None when it is not minified.
+        Resolved once per route, then a single dict lookup.
+        """
+        url_rule = request.url_rule
+        key = (request.endpoint, url_rule.rule if url_rule is not None else None)
+
+        try:
+            return self._route_plans[key]
+        except KeyError:
+            pass
+
+        endpoint, rule = key
+        if rule is not None and rule in self.plan.bypass:
+            plan = None
         else:
-            if self.cache and len(self.hashes) >= self.cache_limit:
-                self._evict_lru_cache(self.hashes)
+            profile = self._resolve_profile(endpoint, rule)
+            plan = self.plan if profile is None else self.profile_plans[profile]
 
-            hashed = md5(text.encode("utf8")).hexdigest()[:9]
-            self.hashes[text] = hashed
-            return hashed
+        self._route_plans[key] = plan
+        return plan
 
-    def _remove_balanced_parens(self, text, start_pos):
+    def load_engines(self):
         """
-        Helper to find and remove text with balanced parentheses.
-        @param: text The text to search in
-        @param: start_pos Position of opening parenthesis
-        @return: End position of closing parenthesis, or -1 if not found
+        Import the libraries of the engines the plan uses, instead of on first use.
         """
-        depth = 0
-        in_string = False
-        string_char = None
-        escape_next = False
+        engines = [self.plan.engines[kind] for tag, kind in self.plan.tag_passes]
 
-        for i in range(start_pos, len(text)):
-            char = text[i]
+        if self.plan.native_pass:
+            engines.append(self.plan.native_engine)
+        elif self.plan.html:
+            engines.append(self.plan.engines["html"])
 
-            if escape_next:
-                escape_next = False
-                continue
+        for engine in engines:
+            engine.load()
 
-            if char == '\\':
-                escape_next = True
-                continue
+    def _warm_up_rules(self):
+        """
+        Return the urls of the GET rules without parameters, bypassed and static rules excluded.
+        """
+        return [
+            rule.rule
+            for rule in self.app.url_map.iter_rules()
+            if "GET" in rule.methods
+            and not rule.arguments
+            and not rule.websocket
+            and rule.endpoint != "static"
+            and rule.rule not in self.plan.bypass
+        ]
 
-            if char in ('"', "'", '`') and not in_string:
-                in_string = True
-                string_char = char
-                continue
+    async def _warm_up_before_serving(self):
+        await self.warm_up(None if self.warm_up_urls is True else self.warm_up_urls)
 
-            if in_string:
-                if char == string_char:
-                    in_string = False
-                    string_char = None
-                continue
+    async def warm_up(self, urls=None):
+        """
+        Render urls through the app test client to fill the caches before taking load.
+        @param: urls The urls to render, the GET rules without parameters when None
+        @return: dict of the rendered urls, loaded cache entries and duration in seconds
+        """
+        started = time.perf_counter()
+        urls = self._warm_up_rules() if urls is None else list(urls)
+        entries = len(self.history) + len(self.responses)
+        semaphore = asyncio.Semaphore(self.warm_up_concurrency)
+        client = self.app.test_client()
 
-            if char == '(':
-                depth += 1
-            elif char == ')':
-                depth -= 1
-                if depth == 0:
-                    return i
+        async def render(url):
+            async with semaphore:
+                try:
+                    await client.get(url)
+                except Exception:
+                    self.app.logger.exception(f"minify warm up failed to render {url}")
 
-        return -1
+        await asyncio.gather(*(render(url) for url in urls))
+        # Responses minified in the background, with stale_while_revalidate
+        await asyncio.gather(*self.app.background_tasks, return_exceptions=True)
 
-    def remove_comments(self, js_code):
+        self.warm_up_report = {
+            "urls": len(urls),
+            "entries": len(self.history) + len(self.responses) - entries,
+            "duration": time.perf_counter() - started,
+        }
+        self.app.logger.info(
+            "minify warm up rendered {urls} urls, loaded {entries} cache entries "
+            "in {duration:.3f}s".format(**self.warm_up_report)
+        )
+        return self.warm_up_report
+
+    def _caches(self):
+        return {
+            "history": self.history,
+            "responses": self.responses,
+            "hashes": self.hashes,
+            "blocks": self.block_extractor.blocks,
+        }
+
+    def cache_stats(self):
         """
-        Remove single-line (//) and multi-line (/* */) comments from JavaScript.
-        Preserves comments inside strings and regex patterns.
-        @param: js_code JavaScript code to process
-        @return: JavaScript code with comments removed
+        Return the statistics of every cache and the minification metrics.
+        @return: dict of the history, responses and hashes stats, and metrics
         """
-        result = []
-        i = 0
-        length = len(js_code)
-        in_string = False
-        string_char = None
-        in_regex = False
-        escape_next = False
-
-        while i < length:
-            char = js_code[i]
-
-            if escape_next:
-                result.append(char)
-                escape_next = False
-                i += 1
-                continue
+        stats = {name: cache.stats() for name, cache in self._caches().items()}
+        stats["metrics"] = dict(self.metrics)
+        return stats
 
-            if char == '\\' and (in_string or in_regex):
-                result.append(char)
-                escape_next = True
-                i += 1
-                continue
+    def top_entries(self, count=10, by="size"):
+        """
+        Return the biggest or most hit entries of the history and responses caches.
+        @param: count The number of entries per cache (default: 10)
+        @param: by Sort by 'size' or 'hits' (default: 'size')
+        @return: dict of the history and responses entries
+        """
+        return {
+            "history": self.history.top(count, by),
+            "responses": self.responses.top(count, by),
+        }
 
-            if char in ('"', "'", '`') and not in_regex:
-                if not in_string:
-                    in_string = True
-                    string_char = char
-                elif char == string_char:
-                    in_string = False
-                    string_char = None
-                result.append(char)
-                i += 1
-                continue
+    def profile_report(self):
+        """
+        Return the report of the fragment profiler, to find the inline blocks and
+        chunks slowing pages down.
+        @return: dict of the slowest and largest fragments, each with its digest, kind,
+        size, seconds, cache outcome, fallback and route, and the totals
+        """
+        if self.profiler is None:
+            raise RuntimeError("fragment profiling requires profile_fragments=True")
 
-            if in_string or in_regex:
-                result.append(char)
-                i += 1
-                continue
+        return self.profiler.snapshot()
 
-            if i + 1 < length and char == '/' and js_code[i + 1] == '/':
-                while i < length and js_code[i] not in ('\n', '\r'):
-                    i += 1
-                if i < length:
-                    result.append(js_code[i])
-                    i += 1
-                continue
+    def _profile(self, kind, cache_key, text, seconds, cache, fallback=False):
+        """
+        Record a fragment in the profiler, when profiling.
+        @param: kind The content kind 'css', 'js' or 'chunk'
+        @param: cache_key The history key of the fragment, ending with its digest
+        @param: text The fragment, str or UTF-8 bytes
+        @param: seconds The time spent on the fragment
+        @param: cache 'hit', 'miss' or 'coalesced'
+        @param: fallback Whether the minification failed (default: False)
+        """
+        if self.profiler is None:
+            return
 
-            if i + 1 < length and char == '/' and js_code[i + 1] == '*':
-                i += 2
-                while i + 1 < length:
-                    if js_code[i] == '*' and js_code[i + 1] == '/':
-                        i += 2
-                        break
-                    i += 1
-                result.append(' ')
-                continue
+        route = None
+        if has_request_context():
+            route = request.url_rule.rule if request.url_rule is not None else request.path
+
+        self.profiler.record(
+            kind, cache_key.rsplit(":", 1)[-1], len(text), seconds, cache, fallback, route
+        )
+
+    def invalidate(self, digest=None, predicate=None):
+        """
+        Remove the history and responses entries of a digest, or matching a predicate.
+        @param: digest The md5 hex digest of the content, or the digest ending the cache key
+        @param: predicate Callable taking the key and value of an entry
+        @return: The number of removed entries
+        """
+        if digest is None and predicate is None:
+            raise ValueError("invalidate requires a digest or a predicate")
+
+        def matches(key, value):
+            # Fragment keys hold md5 digests truncated by get_hashed
+            if digest is not None and not digest.startswith(key.rsplit(":", 1)[-1]):
+                return False
+            return predicate is None or predicate(key, value)
+
+        return self.history.invalidate(matches) + self.responses.invalidate(matches)
+
+    def bump_generation(self):
+        """
+        Make every minified fragment and response stale at once, like after a deploy
+        changing their output, without walking the caches.
+        @return: The new generation
+        """
+        self.responses.bump()
+        return self.history.bump()
+
+    def clear_cache(self):
+        """
+        Remove every entry of every cache.
+        """
+        for cache in self._caches().values():
+            cache.clear()
+
+    def resize(self, cache_limit):
+        """
+        Change the limit of every cache, evicting the least recently used entries over it.
+        @param: cache_limit The new maximum number of entries per cache
+        """
+        self.cache_limit = cache_limit
+        for cache in self._caches().values():
+            cache.resize(cache_limit)
 
-            result.append(char)
-            i += 1
+    def _named_plan(self, profile):
+        """
+        Return the plan of a profile, the default plan when None, None when the
+        profile disables minification.
+        """
+        if profile is None:
+            return self.plan
+
+        if profile not in self.profile_plans:
+            raise ValueError(f"unknown minify profile: {profile!r}")
+
+        return self.profile_plans[profile]
+
+    async def _minify_html_text(self, text, plan):
+        """
+        Minify an HTML document through responses, like a response body.
+        @param: text The HTML document, str or UTF-8 bytes
+        @param: plan The MinifyPlan to run
+        @return: Minified document, str
+        """
+        body = text.encode("utf8") if isinstance(text, str) else text
+        digest, normalized, values = self._response_key(body, plan)
+        minified = self.responses.get(digest) if self.cache else None
+
+        if minified is None:
+            minified = await self._minify_response(normalized, plan)
+            self._store_response(digest, minified)
+
+        minified = fill_tokens(minified, values)
+        return minified.decode("utf8") if isinstance(minified, bytes) else minified
+
+    async def _minify_texts(self, kind, texts, plan):
+        """
+        Minify texts of a kind, returning the exceptions they raise in place.
+        """
+        if kind == "html":
+            return await asyncio.gather(
+                *(self._minify_html_text(text, plan) for text in texts), return_exceptions=True
+            )
+
+        if self.executor is not None:
+            return await self._minify_fragments_async(kind, texts, plan)
+
+        return await asyncio.gather(
+            *(self.store_minifed_async(kind, text, text, plan) for text in texts),
+            return_exceptions=True,
+        )
+
+    async def minify_many(self, items, profile=None):
+        """
+        Minify contents outside of the after request hook, like emails, server sent
+        events or pre-generated pages, through the same plan, caches and executor.
+        HTML documents are cached like responses, scripts and styles like inline tags,
+        and those missing the cache are minified in parallel batches on the executor.
+        @param: items Iterable of (kind, text) pairs, kind 'html', 'js' or 'css', text
+        str or UTF-8 bytes
+        @param: profile Name of the profile to run, the default options when None (default: None)
+        @return: List of the minified texts, str, in the order of items. With fail_safe,
+        the texts failing to minify are returned unminified
+        """
+        plan = self._named_plan(profile)
+        items = list(items)
+        unknown = {kind for kind, text in items} - {"html", "js", "css"}
+        if unknown:
+            raise ValueError(f"unknown content kinds: {', '.join(sorted(unknown))}")
+
+        if plan is None:
+            return [as_text(text) for kind, text in items]
+
+        kinds = {}
+        for index, (kind, text) in enumerate(items):
+            kinds.setdefault(kind, []).append(index)
+
+        results = [None] * len(items)
+        minified_kinds = await asyncio.gather(
+            *(
+                self._minify_texts(kind, [items[index][1] for index in indexes], plan)
+                for kind, indexes in kinds.items()
+            )
+        )
+
+        for indexes, minified in zip(kinds.values(), minified_kinds):
+            for index, result in zip(indexes, minified):
+                if isinstance(result, Exception):
+                    if not self.fail_safe:
+                        raise result
+                    result = as_text(items[index][1])
+                results[index] = result
+
+        return results
+
+    async def minify_html(self, text, profile=None):
+        """
+        Minify an HTML document outside of the after request hook, cached like responses.
+        @param: text The HTML document, str or UTF-8 bytes
+        @param: profile Name of the profile to run, the default options when None (default: None)
+        @return: Minified document, str
+        """
+        [minified] = await self.minify_many([("html", text)], profile)
+        return minified
+
+    async def minify_js(self, text, profile=None):
+        """
+        Minify JavaScript outside of the after request hook, cached like inline scripts.
+        @param: text The JavaScript code, str or UTF-8 bytes
+        @param: profile Name of the profile to run, the default options when None (default: None)
+        @return: Minified JavaScript, str
+        """
+        [minified] = await self.minify_many([("js", text)], profile)
+        return minified
+
+    async def minify_css(self, text, profile=None):
+        """
+        Minify CSS outside of the after request hook, cached like inline styles.
+        @param: text The stylesheet, str or UTF-8 bytes
+        @param: profile Name of the profile to run, the default options when None (default: None)
+        @return: Minified stylesheet, str
+        """
+        [minified] = await self.minify_many([("css", text)], profile)
+        return minified
+
+    def get_hashed(self, text):
+        """
+        Return text hashed and store it in hashes with LRU eviction.
+        @param: text The text (str or UTF-8 bytes) to hash
+        @return: The hash string
+        """
+        hashed = self.hashes.get(text)
 
-        return ''.join(result)
+        if hashed is None:
+            data = text if isinstance(text, bytes) else text.encode("utf8")
+            hashed = md5(data).hexdigest()[:9]
+            self.hashes.set(text, hashed)
 
-    def remove_console_statements(self, js_code):
+        return hashed
+
+    def remove_comments(self, js_code):
+        """
+        Remove single-line (//) and multi-line (/* */) comments from JavaScript.
+        Preserves comments inside strings and regex patterns.
+        @param: js_code JavaScript code to process
+        @return: JavaScript code with comments removed
+        """
+        return remove_comments(js_code)
+
+    def remove_console_statements(self, js_code, plan=None):
         """
         Remove console statements from JavaScript code based on console_types.
-        Uses improved parsing to handle nested parentheses and strings correctly.
         @param: js_code JavaScript code to process
+        @param: plan The MinifyPlan to run, the default plan when None
         @return: JavaScript code with console statements removed
         """
-        if not self.remove_console:
-            return js_code
+        return remove_console_statements(js_code, (plan or self.plan).console_pattern)
 
-        result = js_code
-        for console_type in self.console_types:
-            pattern = rf'\bconsole\.{console_type}\s*\('
-            offset = 0
+    def _cache_key(self, kind, text, plan):
+        """
+        Return the history key of a fragment.
+        @param: kind The content kind 'css', 'js' or 'html'
+        @param: text The text the key is hashed from
+        @param: plan The MinifyPlan whose namespace the key is in
+        @return: The cache key string
+        """
+        return f"{plan.fingerprint}:{kind}:{self.get_hashed(text)}"
 
-            while True:
-                match = re.search(pattern, result[offset:])
-                if not match:
-                    break
+    def _store_history(self, cache_key, minified):
+        """
+        Store a minified fragment in history, using LRU eviction.
+        @param: cache_key The history key of the fragment
+        @param: minified The minified content
+        """
+        if self.cache:
+            self.history.set(cache_key, minified)
 
-                abs_start = offset + match.start()
-                paren_start = offset + match.end() - 1
+    def _preparer(self, kind, plan):
+        """
+        Return the Python-level transforms of a content kind, picklable for process pools.
+        @param: kind The content kind 'css', 'js' or 'html'
+        @param: plan The MinifyPlan to run
+        @return: Callable taking and returning the content, or None
+        """
+        if kind == "js":
+            return partial(
+                prepare_js,
+                console_pattern=plan.console_pattern,
+                debugger_pattern=plan.debugger_pattern,
+            )
 
-                paren_end = self._remove_balanced_parens(result, paren_start)
+        return None
 
-                if paren_end == -1:
-                    offset = paren_start + 1
-                    continue
+    def _prepare_fragment(self, kind, content, plan):
+        """
+        Decode a fragment and apply the Python-level transforms of its kind.
+        @param: kind The content kind 'css', 'js' or 'html'
+        @param: content The content, str or UTF-8 bytes
+        @param: plan The MinifyPlan to run
+        @return: Content ready for the engine of its kind
+        """
+        if isinstance(content, bytes):
+            # Only fragments that miss the cache are decoded for the engines
+            content = content.decode("utf8")
 
-                before = result[:abs_start]
-                after = result[paren_end + 1:]
+        prepare = self._preparer(kind, plan)
+        return content if prepare is None else prepare(content)
 
-                arrow_match = re.search(r'(=>)\s*$', before[-30:] if len(before) >= 30 else before)
+    def _compute_minified(self, kind, content, plan):
+        """
+        Minify a fragment with the engine of its kind, without caching.
+        @param: kind The content kind 'css', 'js' or 'html'
+        @param: content The content, str or UTF-8 bytes
+        @param: plan The MinifyPlan to run
+        @return: Minified content
+        """
+        return plan.engines[kind].minify(self._prepare_fragment(kind, content, plan))
 
-                if arrow_match:
-                    after = re.sub(r'^\s*;?\s*', '', after)
-                    result = before + '{}' + after
-                else:
-                    after = re.sub(r'^\s*;?\s*', '', after)
-                    result = before + after
+    def store_minifed(self, kind, text, to_replace, plan=None):
+        """
+        Minify and store in history with hash key, using LRU eviction.
+        @param: kind The content kind 'css', 'js' or 'html', True and False
+        stand for 'css' and 'js'
+        @param: text The full text being processed
+        @param: to_replace The specific content to minify, str or UTF-8 bytes
+        @param: plan The MinifyPlan to run, the default plan when None
+        @return: Minified content
+        """
+        if isinstance(kind, bool):
+            kind = "css" if kind else "js"
+
+        plan = plan or self.plan
+        started = time.perf_counter()
+        cache_key = self._cache_key(kind, text, plan)
 
-                offset = abs_start
+        minifed = self.history.get(cache_key) if self.cache else None
+        cache = "hit"
 
-        return result
+        if minifed is None:
+            cache = "miss"
+            try:
+                minifed = self._compute_minified(kind, to_replace, plan)
+            except Exception as e:
+                seconds = time.perf_counter() - started
+                self._profile(kind, cache_key, text, seconds, cache, fallback=True)
+                raise e
+            self._store_history(cache_key, minifed)
+
+        self._profile(kind, cache_key, text, time.perf_counter() - started, cache)
+        return minifed
 
-    def store_minifed(self, css, text, to_replace):
+    async def store_minifed_async(self, kind, text, to_replace, plan=None):
         """
-        Minify and store in history with hash key, using LRU eviction.
-        @param: css Whether this is CSS/LESS (True) or JavaScript (False)
+        Awaitable store_minifed, running engines on the executor when one is set.
+        Concurrent misses of the same fragment share a single computation.
+        @param: kind The content kind 'css', 'js' or 'html'
         @param: text The full text being processed
-        @param: to_replace The specific content to minify
+        @param: to_replace The specific content to minify, str or UTF-8 bytes
+        @param: plan The MinifyPlan to run, the default plan when None
         @return: Minified content
         """
-        cache_key = self.get_hashed(text)
+        plan = plan or self.plan
+        started = time.perf_counter()
+        cache_key = self._cache_key(kind, text, plan)
 
-        if self.cache and cache_key in self.history:
-            self.history.move_to_end(cache_key)
-            return self.history[cache_key]
-        else:
-            if css:
-                minifed = compile(StringIO(to_replace), minify=True, xminify=True)
-            else:
-                js_code = self.remove_comments(to_replace)
-                js_code = self.remove_console_statements(js_code)
-                if self.remove_debugger:
-                    js_code = re.sub(r'\bdebugger\s*;?\s*', '', js_code)
+        minifed = self.history.get(cache_key) if self.cache else None
+        if minifed is not None:
+            self._profile(kind, cache_key, text, time.perf_counter() - started, "hit")
+            return minifed
 
-                minifed = rjsmin.jsmin(js_code)
+        if cache_key in self._inflight:
+            self.metrics["coalesced"] += 1
+            shared = self._inflight[cache_key]
+            try:
+                minifed = await asyncio.shield(shared)
+            except asyncio.CancelledError as e:
+                if not shared.cancelled():
+                    raise e
+                # The request computing it was cancelled, compute it again
+                return await self.store_minifed_async(kind, text, to_replace, plan)
+            except Exception as e:
+                seconds = time.perf_counter() - started
+                self._profile(kind, cache_key, text, seconds, "coalesced", fallback=True)
+                raise e
+            self._profile(kind, cache_key, text, time.perf_counter() - started, "coalesced")
+            return minifed
 
-            if self.cache:
-                if len(self.history) >= self.cache_limit:
-                    self._evict_lru_cache(self.history)
-                self.history[cache_key] = minifed
+        loop = asyncio.get_running_loop()
+        future = self._inflight[cache_key] = loop.create_future()
+        self.metrics["computed"] += 1
 
+        try:
+            if self.executor is None:
+                minifed = await plan.engines[kind].minify_async(
+                    self._prepare_fragment(kind, to_replace, plan)
+                )
+            else:
+                [minifed] = await loop.run_in_executor(
+                    self.executor,
+                    minify_batch,
+                    plan.engines[kind],
+                    [to_replace],
+                    self._preparer(kind, plan),
+                )
+                if isinstance(minifed, Exception):
+                    raise minifed
+        except Exception as e:
+            future.set_exception(e)
+            # Mark the exception retrieved when no request is waiting on it
+            future.exception()
+            seconds = time.perf_counter() - started
+            self._profile(kind, cache_key, text, seconds, "miss", fallback=True)
+            raise e
+        else:
+            self._store_history(cache_key, minifed)
+            self._profile(kind, cache_key, text, time.perf_counter() - started, "miss")
+            future.set_result(minifed)
             return minifed
+        finally:
+            if self._inflight.get(cache_key) is future:
+                del self._inflight[cache_key]
+            if not future.done():
+                # Cancelled, the waiting requests compute the fragment again
+                future.cancel()
+
+    def _scan_tags(self, text, tag, plan):
+        """
+        Find the bodies of all occurrences of a specific tag type.
+        @param: text The HTML text to scan, str or UTF-8 bytes
+        @param: tag The tag name ('style' or 'script')
+        @param: plan The MinifyPlan holding the compiled tag patterns
+        @return: List of (start, end, content) of every tag body worth minifying
+        """
+        str_pattern, bytes_pattern = plan.tag_patterns.get(tag) or compile_tag_pattern(tag)
+        pattern = bytes_pattern if isinstance(text, bytes) else str_pattern
+
+        return [
+            match.span(1) + (match.group(1),)
+            for match in pattern.finditer(text)
+            if match.end(1) - match.start(1) > 2
+        ]
+
+    def _splice(self, text, replacements):
+        """
+        Assemble text from its untouched slices and the replaced spans in a single join.
+        UTF-8 bytes are sliced through a memoryview, so nothing is copied until the join.
+        @param: text The HTML text, str or UTF-8 bytes
+        @param: replacements List of (start, end, str) sorted by offset
+        @return: Spliced text, of the same type as text
+        """
+        if not replacements:
+            return text
+
+        is_bytes = isinstance(text, bytes)
+        source = memoryview(text) if is_bytes else text
+        parts = []
+        position = 0
+
+        for start, end, replacement in replacements:
+            parts.append(source[position:start])
+            parts.append(replacement.encode("utf8") if is_bytes else replacement)
+            position = end
+
+        parts.append(source[position:])
+        return text[:0].join(parts)
+
+    def _used_selectors(self, text, tag, bodies, plan):
+        """
+        Return the UsedSelectors of a document whose style bodies get pruned, otherwise None.
+        @param: text The HTML text, str or UTF-8 bytes
+        @param: tag The tag name of the bodies
+        @param: bodies The bodies found by _scan_tags
+        @param: plan The MinifyPlan to run
+        """
+        if tag != "style" or not plan.prune_css or not bodies:
+            return None
+
+        return collect_selectors(text, plan.prune_css_keep)
 
-    def _find_and_minify_tags(self, text, tag, is_css):
+    def _prune_style(self, content, minified, used, plan):
+        """
+        Prune a minified style body, cached by its digest and the selectors of the document.
+        @param: content The original style body
+        @param: minified The minified style body
+        @param: used The UsedSelectors of the document
+        @param: plan The MinifyPlan to run
+        @return: Pruned style body
+        """
+        cache_key = f"{plan.fingerprint}:css:{used.fingerprint}:{self.get_hashed(content)}"
+        pruned = self.history.get(cache_key) if self.cache else None
+
+        if pruned is None:
+            pruned = prune_css(minified, used)
+            self._store_history(cache_key, pruned)
+
+        return pruned
+
+    def _replacement(self, text, start, end, tag, minified, plan):
+        """
+        Return the replacement of a minified tag body, or of the whole tag once extracted.
+        @param: text The HTML text, str or UTF-8 bytes
+        @param: start The start offset of the tag body
+        @param: end The end offset of the tag body
+        @param: tag The tag name ('style' or 'script')
+        @param: minified The minified tag body
+        @param: plan The MinifyPlan to run
+        @return: Tuple of (start, end, str)
+        """
+        if plan.extract_min_size and len(minified) >= plan.extract_min_size:
+            extracted = self.block_extractor.extract(text, start, end, tag, minified)
+            if extracted is not None:
+                return extracted
+
+        return start, end, minified
+
+    def _find_and_minify_tags(self, text, tag, kind, plan=None):
         """
         Find and minify all occurrences of a specific tag type.
-        Uses regex to properly isolate each tag and its content.
-        @param: text The HTML text to process
+        Records the offsets of each tag body and assembles the output from
+        the untouched slices and the minified bodies in a single join.
+        @param: text The HTML text to process, str or UTF-8 bytes
         @param: tag The tag name ('style' or 'script')
-        @param: is_css Whether this is CSS (True) or JavaScript (False)
-        @return: Processed HTML text
+        @param: kind The content kind of the tag body ('css' or 'js')
+        @param: plan The MinifyPlan to run, the default plan when None
+        @return: Processed HTML text, of the same type as text
+        """
+        plan = plan or self.plan
+        replacements = []
+        bodies = self._scan_tags(text, tag, plan)
+        used = self._used_selectors(text, tag, bodies, plan)
+
+        for start, end, content in bodies:
+            try:
+                minified = self.store_minifed(kind, content, content, plan)
+                if used is not None:
+                    minified = self._prune_style(content, minified, used, plan)
+            except Exception as e:
+                if self.fail_safe:
+                    # Keep original tag content if minification fails
+                    continue
+                else:
+                    raise e
+
+            replacements.append(self._replacement(text, start, end, tag, minified, plan))
+
+        return self._splice(text, replacements)
+
+    def _batches(self, fragments):
         """
-        import re
+        Group fragments into batches of at least executor_batch_size characters.
+        @param: fragments List of (cache key, content)
+        @return: List of the batches
+        """
+        batches = []
+        batch = []
+        size = 0
+
+        for fragment in fragments:
+            batch.append(fragment)
+            size += len(fragment[1])
+            if size >= self.executor_batch_size:
+                batches.append(batch)
+                batch = []
+                size = 0
 
-        pattern = rf'<{tag}(?:\s+[^>]*)?>(.+?)<\/{tag}>'
+        if batch:
+            batches.append(batch)
 
-        def replace_tag_content(match):
-            """Replace the content of a single tag with its minified version"""
-            content = match.group(1)
+        return batches
 
-            if len(content) <= 2:
-                return match.group(0)
+    async def _minify_batch(self, kind, batch, futures, plan):
+        """
+        Minify a batch of fragments in a single executor call, transforms included,
+        storing them in history and resolving their futures.
+        @param: kind The content kind 'css' or 'js'
+        @param: batch List of (cache key, content)
+        @param: futures Cache keys to the futures of their minified content
+        @param: plan The MinifyPlan to run
+        """
+        loop = asyncio.get_running_loop()
+
+        try:
+            results = await loop.run_in_executor(
+                self.executor,
+                minify_batch,
+                plan.engines[kind],
+                [content for cache_key, content in batch],
+                self._preparer(kind, plan),
+                True,
+            )
+        except Exception as e:
+            results = [(e, 0.0)] * len(batch)
 
+        for (cache_key, content), (result, seconds) in zip(batch, results):
+            future = futures[cache_key]
+            if self._inflight.get(cache_key) is future:
+                del self._inflight[cache_key]
+            fallback = isinstance(result, Exception)
+            self._profile(kind, cache_key, content, seconds, "miss", fallback=fallback)
+
+            if fallback:
+                future.set_exception(result)
+                # Mark the exception retrieved when no request is waiting on it
+                future.exception()
+            else:
+                self._store_history(cache_key, result)
+                future.set_result(result)
+
+    async def _minify_fragments_async(self, kind, contents, plan):
+        """
+        Minify fragments on the executor. The fragments missing the cache are
+        batched and the batches minified in parallel, while the fragments other
+        requests are minifying are awaited.
+        @param: kind The content kind 'css' or 'js'
+        @param: contents List of the fragments, str or UTF-8 bytes
+        @param: plan The MinifyPlan to run
+        @return: List of the minified fragments, or of the exceptions they raised
+        """
+        loop = asyncio.get_running_loop()
+        started = time.perf_counter()
+        keys = [self._cache_key(kind, content, plan) for content in contents]
+        results = {}
+        futures = {}
+        coalesced = {}  # cache keys minified by other requests to their content
+        missed = []
+
+        for cache_key, content in zip(keys, contents):
+            if cache_key in results or cache_key in futures:
+                continue
+
+            minified = self.history.get(cache_key) if self.cache else None
+            if minified is not None:
+                results[cache_key] = minified
+                self._profile(kind, cache_key, content, time.perf_counter() - started, "hit")
+            elif cache_key in self._inflight:
+                self.metrics["coalesced"] += 1
+                futures[cache_key] = self._inflight[cache_key]
+                coalesced[cache_key] = content
+            else:
+                futures[cache_key] = self._inflight[cache_key] = loop.create_future()
+                missed.append((cache_key, content))
+
+        if missed:
+            batches = self._batches(missed)
+            self.metrics["computed"] += len(missed)
+            self.metrics["batches"] += len(batches)
             try:
-                minified = self.store_minifed(is_css, content, content)
-                return match.group(0).replace(content, minified)
+                await asyncio.gather(
+                    *(self._minify_batch(kind, batch, futures, plan) for batch in batches)
+                )
+            finally:
+                for cache_key, content in missed:
+                    future = futures[cache_key]
+                    if self._inflight.get(cache_key) is future:
+                        del self._inflight[cache_key]
+                    if not future.done():
+                        # Cancelled, the waiting requests minify the fragment again
+                        future.cancel()
+
+        retried = {}  # cache keys whose shared minification was cancelled to their content
+        for cache_key, future in futures.items():
+            try:
+                results[cache_key] = await asyncio.shield(future)
+            except asyncio.CancelledError as e:
+                if not future.cancelled():
+                    raise e
+                retried[cache_key] = coalesced[cache_key]
+                continue
+            except Exception as e:
+                results[cache_key] = e
+
+            if cache_key in coalesced:
+                self._profile(
+                    kind,
+                    cache_key,
+                    coalesced[cache_key],
+                    time.perf_counter() - started,
+                    "coalesced",
+                    fallback=isinstance(results[cache_key], Exception),
+                )
+
+        if retried:
+            minified = await self._minify_fragments_async(kind, list(retried.values()), plan)
+            results.update(zip(retried, minified))
+
+        return [results[cache_key] for cache_key in keys]
+
+    async def _find_and_minify_tags_async(self, text, tag, kind, plan):
+        """
+        Awaitable _find_and_minify_tags, minifying through store_minifed_async,
+        or in parallel batches when an executor is set.
+        @param: text The HTML text to process, str or UTF-8 bytes
+        @param: tag The tag name ('style' or 'script')
+        @param: kind The content kind of the tag body ('css' or 'js')
+        @param: plan The MinifyPlan to run
+        @return: Processed HTML text, of the same type as text
+        """
+        replacements = []
+        bodies = self._scan_tags(text, tag, plan)
+        used = self._used_selectors(text, tag, bodies, plan)
+        if self.executor is not None and bodies:
+            minified_bodies = await self._minify_fragments_async(
+                kind, [content for start, end, content in bodies], plan
+            )
+
+        for index, (start, end, content) in enumerate(bodies):
+            try:
+                if self.executor is None:
+                    minified = await self.store_minifed_async(kind, content, content, plan)
+                elif isinstance(minified_bodies[index], Exception):
+                    raise minified_bodies[index]
+                else:
+                    minified = minified_bodies[index]
+
+                if used is not None:
+                    minified = self._prune_style(content, minified, used, plan)
             except Exception as e:
                 if self.fail_safe:
-                    # Return original tag if minification fails
-                    return match.group(0)
+                    continue
                 else:
                     raise e
 
-        return re.sub(pattern, replace_tag_content, text, flags=re.DOTALL)
+            replacements.append(self._replacement(text, start, end, tag, minified, plan))
 
-    async def to_loop_tag(self, response):
-        if (
-            response.content_type == "text/html; charset=utf-8"
-            and (request.url_rule is None or request.url_rule.rule not in self.bypass)
-        ):
-            response.direct_passthrough = False
-            result = response.get_data(as_text=True)
-            text = (await result) if asyncio.iscoroutine(result) else result
+        return self._splice(text, replacements)
+
+    def _minify_native(self, body, plan):
+        """
+        Minify a document, inline CSS and JS included, with the single native engine call.
+        @param: body The document, str or UTF-8 bytes
+        @param: plan The MinifyPlan to run
+        @return: Minified document
+        """
+        if isinstance(body, bytes):
+            body = body.decode("utf8")
+
+        return plan.native_engine.minify(body)
+
+    def _minify_html(self, body, plan):
+        """
+        Minify a document with the html engine, if html minification is on.
+        @param: body The document, str or UTF-8 bytes
+        @param: plan The MinifyPlan to run
+        @return: Minified document, str once minified, otherwise the type of body
+        """
+        if not plan.html:
+            return body
+
+        if plan.chunk_size:
+            try:
+                return self._minify_html_chunked(body, plan)
+            except Exception:
+                # Chunks the engine rejects, like unbalanced markup a strict engine
+                # raises on, fall back to the whole document
+                self.metrics["chunk_fallbacks"] += 1
 
-            if self.cssless:
-                text = self._find_and_minify_tags(text, "style", True)
+        html_engine = plan.engines["html"]
+        if isinstance(body, bytes) and not html_engine.accepts_bytes:
+            body = body.decode("utf8")
 
-            if self.js:
-                text = self._find_and_minify_tags(text, "script", False)
+        return html_engine.minify(body)
 
-            final_resp = minify_html_onepass.minify(text, minify_js=False, minify_css=False) if self.html else text
-            response.set_data(final_resp)
+    def _minify_chunk(self, chunk, plan):
+        """
+        Minify a chunk, cached by its digest.
+        @param: chunk The chunk
+        @param: plan The MinifyPlan to run
+        @return: Minified chunk
+        """
+        started = time.perf_counter()
+        cache_key = self._cache_key("chunk", chunk, plan)
+        minified = self.history.get(cache_key) if self.cache else None
+        if minified is not None:
+            self._profile("chunk", cache_key, chunk, time.perf_counter() - started, "hit")
+            return minified
+
+        try:
+            minified = self._compute_chunk(chunk, plan)
+        except Exception as e:
+            seconds = time.perf_counter() - started
+            self._profile("chunk", cache_key, chunk, seconds, "miss", fallback=True)
+            raise e
+
+        self._store_history(cache_key, minified)
+        self._profile("chunk", cache_key, chunk, time.perf_counter() - started, "miss")
+        return minified
+
+    def _compute_chunk(self, chunk, plan):
+        """
+        Split a chunk into balanced pieces, minified by the html engine, and unmatched
+        tags kept as is. The whitespace around pieces collapses to a single space.
+        @param: chunk The chunk
+        @param: plan The MinifyPlan to run
+        @return: Minified chunk
+        """
+        html_engine = plan.engines["html"]
+        parts = []
+
+        for start, end, balanced in balanced_spans(chunk):
+            piece = chunk[start:end]
+            if not balanced:
+                parts.append(piece)
+                continue
+
+            stripped = piece.strip()
+            if piece[:1].isspace() and not (parts and parts[-1] == " "):
+                parts.append(" ")
+            if not stripped:
+                continue
+
+            result = html_engine.minify(stripped + SENTINEL)
+            if not result.endswith(SENTINEL):
+                raise ValueError("the html engine did not keep the chunk boundary")
+
+            parts.append(result[:-len(SENTINEL)])
+            if piece[-1:].isspace():
+                parts.append(" ")
+
+        return "".join(parts)
+
+    def _minify_html_chunked(self, body, plan):
+        """
+        Minify a document chunk by chunk, only the chunks missing the cache go
+        through the html engine.
+        @param: body The document, str or UTF-8 bytes
+        @param: plan The MinifyPlan to run
+        @return: Minified document
+        """
+        if isinstance(body, bytes):
+            body = body.decode("utf8")
+
+        parts = []
+
+        for chunk in split_chunks(body, plan.chunk_size):
+            minified = self._minify_chunk(chunk, plan)
+            if minified[:1] == " " and parts and parts[-1][-1:] == " ":
+                minified = minified[1:]
+            parts.append(minified)
+
+        return "".join(parts)
+
+    def _inline_assets(self, body, plan):
+        """
+        Inline the small static assets of a document, if enabled by the plan.
+        Runs after the tag passes, the inlined assets are already minified.
+        @param: body The document, str or UTF-8 bytes
+        @param: plan The MinifyPlan to run
+        @return: Document of the same type as body
+        """
+        if not plan.inline_assets_limit:
+            return body
+
+        return self.asset_inliner.inline(body, plan)
+
+    def _minify_document(self, body, plan=None):
+        """
+        Run the minification pipeline over a whole HTML document.
+        @param: body The document, str or UTF-8 bytes
+        @param: plan The MinifyPlan to run, the default plan when None
+        @return: Minified document, str once minified as HTML, otherwise the type of body
+        """
+        plan = plan or self.plan
+
+        if plan.native_pass:
+            return self._minify_native(self._inline_assets(body, plan), plan)
+
+        for tag, kind in plan.tag_passes:
+            body = self._find_and_minify_tags(body, tag, kind, plan)
+
+        return self._minify_html(self._inline_assets(body, plan), plan)
+
+    async def _minify_document_async(self, body, plan=None):
+        """
+        Awaitable _minify_document, minifying tag bodies through store_minifed_async.
+        @param: body The document, str or UTF-8 bytes
+        @param: plan The MinifyPlan to run, the default plan when None
+        @return: Minified document, str once minified as HTML, otherwise the type of body
+        """
+        plan = plan or self.plan
+
+        if plan.native_pass:
+            return self._minify_native(self._inline_assets(body, plan), plan)
+
+        for tag, kind in plan.tag_passes:
+            body = await self._find_and_minify_tags_async(body, tag, kind, plan)
+
+        return self._minify_html(self._inline_assets(body, plan), plan)
+
+    async def _template_rendered(self, sender, template, context, **extra):
+        """
+        Track whether every template rendered for the request was minified at load time.
+        """
+        prerendered = template.name in self.minified_templates
+        g._minify_prerendered = g.get("_minify_prerendered", True) and prerendered
+
+    def _store_response(self, digest, minified):
+        """
+        Store a minified response body in responses, using LRU eviction.
+        @param: digest The digest of the original body
+        @param: minified The minified body
+        """
+        if self.cache:
+            self.responses.set(digest, minified)
+
+    def _schedule_minify(self, digest, body, plan):
+        """
+        Minify a response body in a background task, unless it is already
+        pending or the pending tasks are at background_limit.
+        @param: digest The digest of the body
+        @param: body The response body
+        @param: plan The MinifyPlan to run
+        @return: Whether a task was scheduled
+        """
+        if digest in self._pending or len(self._pending) >= self.background_limit:
+            return False
+
+        self._pending.add(digest)
+        current_app.add_background_task(self._minify_in_background, digest, body, plan)
+        return True
+
+    async def _minify_response(self, body, plan):
+        """
+        Minify a response body, normalized when the plan has volatile tokens.
+        @param: body The response body
+        @param: plan The MinifyPlan to run
+        @return: Minified body, with the placeholders of volatile values quoted in attributes
+        """
+        minified = await self._minify_document_async(body, plan)
+
+        if plan.volatile_tokens and isinstance(minified, str):
+            minified = quote_placeholders(minified)
+
+        return minified
+
+    def _response_key(self, body, plan):
+        """
+        Normalize a response body and return its key in responses.
+        @param: body The response body, UTF-8 bytes
+        @param: plan The MinifyPlan to run
+        @return: Tuple of the digest, the normalized body and the volatile values
+        """
+        normalized, values = body, None
+        if plan.volatile_tokens:
+            # Pages only differing in nonces and tokens share a cache entry
+            normalized, values = normalize_tokens(body, plan.volatile_tokens)
+
+        if plan.inline_assets_limit and self.asset_inliner.refresh():
+            # Cached responses may hold the previous content of an inlined asset
+            self.responses.clear()
+
+        return f"{plan.fingerprint}:{md5(normalized).hexdigest()}", normalized, values
+
+    async def _minify_in_background(self, digest, body, plan):
+        try:
+            self._store_response(digest, await self._minify_response(body, plan))
+        except Exception as e:
+            if not self.fail_safe:
+                raise e
+        finally:
+            self._pending.discard(digest)
+
+    async def to_loop_tag(self, response):
+        if response.content_type == "text/html; charset=utf-8":
+            plan = self._route_plan()
+            if plan is None:
+                return response
+            if plan is self.plan and g.get("_minify_prerendered", False):
+                # Templates minified at load time already ran the default plan
+                return response
+
+            response.direct_passthrough = False
+            result = response.get_data()
+            body = (await result) if asyncio.iscoroutine(result) else result
+            digest, normalized, values = self._response_key(body, plan)
+            minified = self.responses.get(digest) if self.cache else None
+
+            if minified is not None:
+                response.set_data(fill_tokens(minified, values))
+            elif self.stale_while_revalidate:
+                # Send the body unminified, the next requests get the minified one
+                self._schedule_minify(digest, normalized, plan)
+            else:
+                minified = await self._minify_response(normalized, plan)
+                self._store_response(digest, minified)
+                response.set_data(fill_tokens(minified, values))
 
         return response
@@ -0,0 +1,135 @@
+from collections import namedtuple
+from hashlib import md5
+import re
+
+from quart_minify.engines import MinifyHtmlEngine, library_version, resolve_engines
+from quart_minify.tokens import compile_tokens
+
+MinifyPlan = namedtuple(
+    "MinifyPlan",
+    [
+        "html",  # whether documents go through the html engine
+        "native_pass",  # whether documents go through the single native engine call
+        "tag_passes",  # (tag, kind) pairs minified by the Python tag pass, in order
+        "tag_patterns",  # tag to (str pattern, bytes pattern) matching its body
+        "console_pattern",  # console statements to remove, or None
+        "debugger_pattern",  # debugger statements to remove, or None
+        "bypass",  # frozenset of the bypassed url rules
+        "engines",  # kind to Engine instance
+        "native_engine",  # Engine of the native pass, or None
+        "fingerprint",  # digest of the options and library versions, namespacing the cache keys
+        "profile",  # name of the profile the plan was compiled for, or None
+        "inline_assets_limit",  # maximum size of the inlined static assets, 0 when disabled
+        "prune_css",  # whether inline styles are pruned of the selectors the document misses
+        "prune_css_keep",  # tag names, '#ids' and '.classes' pruning considers present
+        "extract_min_size",  # minimum size of the extracted inline blocks, 0 when disabled
+        "chunk_size",  # minimum size of the cached document chunks, 0 when disabled
+        "volatile_tokens",  # compiled patterns of the per request values, normalized away
+    ],
+)
+
+# Options a profile can override
+PROFILE_OPTIONS = frozenset((
+    "html", "js", "cssless", "native", "remove_console", "console_types", "remove_debugger",
+    "engines", "inline_assets", "prune_css", "extract_blocks", "chunked", "volatile_tokens",
+))
+
+TAG_PATTERN = r'<{tag}(?:\s+[^>]*)?>(.+?)<\/{tag}>'
+
+
+def compile_tag_pattern(tag):
+    """
+    Compile the patterns matching the body of a tag in str and UTF-8 bytes documents.
+    @param: tag The tag name
+    @return: Tuple of the str and bytes patterns
+    """
+    pattern = TAG_PATTERN.format(tag=tag)
+    return re.compile(pattern, re.DOTALL), re.compile(pattern.encode(), re.DOTALL)
+
+
+def build_plan(minify, profile=None, overrides=None):
+    """
+    Compile the options of a Minify instance into an immutable plan.
+    @param: minify The Minify instance
+    @param: profile The name of the profile the plan is compiled for (default: None)
+    @param: overrides Options of the profile overriding the Minify options (default: None)
+    @return: MinifyPlan
+    """
+    overrides = overrides or {}
+    unknown = set(overrides) - PROFILE_OPTIONS
+    if unknown:
+        raise ValueError(f"profiles can not override: {', '.join(sorted(unknown))}")
+
+    def option(name):
+        return overrides.get(name, getattr(minify, name))
+
+    html, js, cssless, native = option("html"), option("js"), option("cssless"), option("native")
+    remove_console, remove_debugger = option("remove_console"), option("remove_debugger")
+    console_types = option("console_types")
+    inline_assets_limit = minify.inline_assets_limit if option("inline_assets") else 0
+    prune_css = cssless and option("prune_css")
+    extract_min_size = minify.extract_min_size if option("extract_blocks") else 0
+    chunk_size = minify.chunk_size if option("chunked") else 0
+    volatile_tokens = tuple(option("volatile_tokens"))
+    engines = resolve_engines(overrides["engines"]) if "engines" in overrides else minify.engines
+    html_engine = engines["html"]
+    python_js_transforms = remove_console or remove_debugger or extract_min_size
+    python_css_transforms = prune_css or extract_min_size
+    tag_passes = []
+
+    # Inline tags are left to the html engine when it minifies them natively,
+    # unless transforms only the Python pass implements are enabled.
+    if cssless and not (html and html_engine.inline_css and not python_css_transforms):
+        tag_passes.append(("style", "css"))
+
+    if js and not (html and html_engine.inline_js and not python_js_transforms):
+        tag_passes.append(("script", "js"))
+
+    console_pattern = None
+    if remove_console and console_types:
+        console_types_pattern = "|".join(re.escape(console_type) for console_type in console_types)
+        console_pattern = re.compile(rf'\bconsole\.(?:{console_types_pattern})\s*\(')
+
+    native_engine = MinifyHtmlEngine(minify_js=js, minify_css=cssless) if native else None
+    options = (
+        library_version("quart-minify"),
+        profile,
+        html,
+        js,
+        cssless,
+        native,
+        remove_console,
+        tuple(sorted(console_types)),
+        remove_debugger,
+        inline_assets_limit,
+        prune_css,
+        tuple(sorted(minify.prune_css_keep)),
+        extract_min_size,
+        chunk_size,
+        volatile_tokens,
+        tuple(
+            (kind, type(engine).__name__, engine.version, engine.inline_js, engine.inline_css)
+            for kind, engine in sorted(engines.items())
+        ),
+        native_engine and native_engine.version,
+    )
+
+    return MinifyPlan(
+        html=html,
+        native_pass=native and html and not (python_js_transforms or python_css_transforms),
+        tag_passes=tuple(tag_passes),
+        tag_patterns={tag: compile_tag_pattern(tag) for tag, kind in tag_passes},
+        console_pattern=console_pattern,
+        debugger_pattern=re.compile(r'\bdebugger\s*;?\s*') if remove_debugger else None,
+        bypass=frozenset(minify.bypass),
+        engines=dict(engines),
+        native_engine=native_engine,
+        fingerprint=md5(repr(options).encode("utf8")).hexdigest()[:8],
+        profile=profile,
+        inline_assets_limit=inline_assets_limit,
+        prune_css=prune_css,
+        prune_css_keep=tuple(minify.prune_css_keep),
+        extract_min_size=extract_min_size,
+        chunk_size=chunk_size,
+        volatile_tokens=compile_tokens(volatile_tokens),
+    )
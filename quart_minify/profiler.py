@@ -0,0 +1,85 @@
+from collections import Counter
+import heapq
+import itertools
+import threading
+
+RECORD_FIELDS = ("digest", "kind", "size", "seconds", "cache", "fallback", "route")
+
+
+class FragmentProfiler:
+    """
+    Records how long each fragment took to minify, keeping the slowest and the
+    largest in bounded heaps, and totals per cache outcome. Safe to share
+    between threads.
+    """
+
+    def __init__(self, size=20):
+        """
+        @param: size Number of fragments kept in each report (default: 20)
+        """
+        self.size = size
+        self._lock = threading.Lock()
+        self._counter = itertools.count()  # tie breaker of the heap items
+        self.reset()
+
+    def reset(self):
+        """
+        Forget every recorded fragment.
+        """
+        with self._lock:
+            self._slowest = []  # min heaps of (priority, counter, record)
+            self._largest = []
+            self.totals = Counter()
+            self.seconds = 0.0
+
+    def _push(self, heap, priority, record):
+        if len(heap) < self.size:
+            heapq.heappush(heap, (priority, next(self._counter), record))
+        elif priority > heap[0][0]:
+            heapq.heapreplace(heap, (priority, next(self._counter), record))
+
+    def record(self, kind, digest, size, seconds, cache, fallback=False, route=None):
+        """
+        Record the minification of a fragment.
+        @param: kind The content kind 'css', 'js' or 'chunk'
+        @param: digest The digest of the fragment
+        @param: size The size of the fragment
+        @param: seconds The time spent on the fragment
+        @param: cache 'hit', 'miss' or 'coalesced' with a concurrent minification
+        @param: fallback Whether the minification failed and the fragment was kept as is
+        (default: False)
+        @param: route The url rule of the request, None outside requests (default: None)
+        """
+        record = (digest, kind, size, seconds, cache, fallback, route)
+
+        with self._lock:
+            self.totals[cache] += 1
+            self.totals["fallbacks"] += fallback
+            self.seconds += seconds
+            self._push(self._slowest, seconds, record)
+            if cache == "miss":
+                # Hits of the same fragment would crowd out the others
+                self._push(self._largest, size, record)
+
+    def snapshot(self):
+        """
+        Return the report of the recorded fragments.
+        @return: dict of the slowest and largest fragment records, most first,
+        the number of hits, misses, coalesced and fallbacks, and the total seconds
+        """
+        with self._lock:
+            return {
+                "slowest": [
+                    dict(zip(RECORD_FIELDS, record))
+                    for *_, record in sorted(self._slowest, reverse=True)
+                ],
+                "largest": [
+                    dict(zip(RECORD_FIELDS, record))
+                    for *_, record in sorted(self._largest, reverse=True)
+                ],
+                "hits": self.totals["hit"],
+                "misses": self.totals["miss"],
+                "coalesced": self.totals["coalesced"],
+                "fallbacks": self.totals["fallbacks"],
+                "seconds": self.seconds,
+            }
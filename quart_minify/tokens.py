@@ -0,0 +1,70 @@
+import re
+
+from quart_minify.jinja import PLACEHOLDER, PLACEHOLDER_PATTERN
+
+# Per request values: CSP nonces, CSRF tokens of Flask-WTF hidden inputs and meta tags
+VOLATILE_TOKENS = (
+    r'\bnonce=["\']?([^"\'\s>]+)',
+    r'<input\b[^>]*\bname=["\']?csrf_token\b[^>]*\bvalue=["\']?([^"\'\s>]+)',
+    r'<meta\b[^>]*\bname=["\']?csrf-token\b[^>]*\bcontent=["\']?([^"\'\s>]+)',
+)
+# Volatile values are replaced by the Jinja placeholders, which pass through
+# every minifier unchanged, and quoted again the same way in attributes.
+PLACEHOLDER_BYTES_PATTERN = re.compile(PLACEHOLDER_PATTERN.pattern.encode())
+
+
+def compile_tokens(patterns):
+    """
+    Compile volatile token patterns for UTF-8 bytes bodies.
+    @param: patterns Patterns, str or bytes, whose first group, or whole match
+    without groups, is the volatile value
+    @return: Tuple of the compiled patterns
+    """
+    return tuple(
+        re.compile(pattern.encode() if isinstance(pattern, str) else pattern)
+        for pattern in patterns
+    )
+
+
+def normalize_tokens(body, patterns):
+    """
+    Replace the volatile values of a body with placeholders.
+    @param: body The UTF-8 bytes body
+    @param: patterns The compiled volatile token patterns
+    @return: Tuple of the normalized body and the replaced values, the body
+    and None when it holds placeholders already
+    """
+    if PLACEHOLDER_BYTES_PATTERN.search(body):
+        return body, None
+
+    values = []
+
+    def to_placeholder(match):
+        group = 1 if match.re.groups else 0
+        values.append(match.group(group))
+        offset = match.start()
+        whole = match.group(0)
+        placeholder = PLACEHOLDER.format(len(values) - 1).encode()
+        return whole[:match.start(group) - offset] + placeholder + whole[match.end(group) - offset:]
+
+    for pattern in patterns:
+        body = pattern.sub(to_placeholder, body)
+
+    return body, values
+
+
+def fill_tokens(minified, values):
+    """
+    Put the volatile values back into a minified body, in a single pass.
+    @param: minified The minified normalized body, str or UTF-8 bytes
+    @param: values The values returned by normalize_tokens
+    @return: Body of the same type as minified
+    """
+    if not values:
+        return minified
+
+    if isinstance(minified, bytes):
+        return PLACEHOLDER_BYTES_PATTERN.sub(lambda match: values[int(match.group(1))], minified)
+
+    texts = [value.decode("utf8") for value in values]
+    return PLACEHOLDER_PATTERN.sub(lambda match: texts[int(match.group(1))], minified)
@@ -38,6 +38,7 @@ setuptools.setup(
         "lesscpy>=0.13.0",
         "quart>=0.10.0",
     ],
+    extras_require={"native": ["minify-html>=0.15.0"]},
     tests_require=[
         "pytest>=5.1,<6.0",
         "pytest-asyncio>=0.10.0,<0.11.0",
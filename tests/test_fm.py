@@ -1,6 +1,13 @@
+import asyncio
+import os
+import re
+import time
+from concurrent.futures import ThreadPoolExecutor
+
 import pytest
 from pytest import fixture
 from quart import Quart
+from quart_minify.engines import Engine
 from quart_minify.minify import Minify
 
 app = Quart(__name__)
@@ -1139,4 +1146,1340 @@ async def test_console_with_object_methods():
     assert b'method1' in data
     assert b'method2' in data
     assert b'method3' in data
-    assert b'return true' in data or b'return' in data
\ No newline at end of file
+    assert b'return true' in data or b'return' in data
+
+
+@pytest.mark.asyncio
+async def test_custom_engine_registry():
+    """ testing registered engines replace the default backends """
+    from quart_minify import Engine, register_engine
+
+    @register_engine
+    class UpperJSEngine(Engine):
+        name = "upper"
+        kind = "js"
+
+        def minify(self, text):
+            return text.strip().upper()
+
+    test_app = Quart(__name__)
+
+    @test_app.route("/custom_engine")
+    def custom_engine():
+        return """<script>
+        var x = 5;
+    </script>"""
+
+    minify_instance = Minify(
+        app=test_app, html=False, js=True, engines={"js": "upper"}, cache=False
+    )
+
+    test_client = test_app.test_client()
+    resp = await test_client.get("/custom_engine")
+    data = await resp.get_data()
+
+    assert isinstance(minify_instance.engines["js"], UpperJSEngine)
+    assert b'<script>VAR X = 5;</script>' == data
+
+
+def test_unknown_engine():
+    """ testing unknown engines and kinds are rejected """
+    with pytest.raises(ValueError):
+        Minify(engines={"js": "missing"})
+
+    with pytest.raises(ValueError):
+        Minify(engines={"xml": "rjsmin"})
+
+
+@pytest.mark.asyncio
+async def test_minify_html_engine_inline():
+    """ testing minify_html engine minifying inline JS and CSS natively """
+    from quart_minify.engines import MinifyHtmlEngine
+
+    test_app = Quart(__name__)
+
+    @test_app.route("/native_inline")
+    def native_inline():
+        return """<html>
+    <head>
+        <style>
+            body { color : red; }
+        </style>
+    </head>
+    <body>
+        <script>
+            var message  =  'Hello';
+        </script>
+    </body>
+</html>"""
+
+    Minify(
+        app=test_app,
+        engines={"html": MinifyHtmlEngine(minify_js=True, minify_css=True)},
+        cache=False
+    )
+
+    test_client = test_app.test_client()
+    resp = await test_client.get("/native_inline")
+    data = await resp.get_data()
+
+    assert b'body{color:red}' in data
+    assert b'  ' not in data
+
+
+@pytest.mark.asyncio
+async def test_native_mode():
+    """ testing native mode minifies the whole document in one pass """
+    test_app = Quart(__name__)
+
+    @test_app.route("/native")
+    def native():
+        return """<html>
+    <body>
+        <h1>  Native  </h1>
+        <style>
+            h1 { color : red; }
+        </style>
+        <script>
+            window.answer = 40  +  2;
+        </script>
+    </body>
+</html>"""
+
+    minify_instance = Minify(app=test_app, native=True)
+
+    test_client = test_app.test_client()
+    resp = await test_client.get("/native")
+    data = await resp.get_data()
+
+    assert b'<h1>Native</h1>' in data
+    assert b'h1{color:red}' in data
+    assert b'window.answer' in data
+    # No fragment went through the Python pass
+    assert len(minify_instance.history) == 0
+
+
+@pytest.mark.asyncio
+async def test_native_mode_with_console_removal():
+    """ testing native mode falls back to the Python pass for console removal """
+    test_app = Quart(__name__)
+
+    @test_app.route("/native_console")
+    def native_console():
+        return """<html><body><script>
+        console.log('removed');
+        window.x = 5;
+    </script></body></html>"""
+
+    minify_instance = Minify(app=test_app, native=True, remove_console=True)
+
+    test_client = test_app.test_client()
+    resp = await test_client.get("/native_console")
+    data = await resp.get_data()
+
+    assert b'console.log' not in data
+    assert b'window.x=5' in data
+    assert len(minify_instance.history) == 1
+
+
+@pytest.mark.asyncio
+async def test_tag_content_repeated_in_attributes():
+    """ testing only the tag body is replaced when attributes contain the same text """
+    test_app = Quart(__name__)
+
+    @test_app.route("/repeated_content")
+    def repeated_content():
+        return """<script data-source="var  x = 5;">var  x = 5;</script><p>var  x = 5;</p>"""
+
+    Minify(app=test_app, html=False, js=True, cache=False)
+
+    test_client = test_app.test_client()
+    resp = await test_client.get("/repeated_content")
+    data = await resp.get_data()
+
+    assert data == b'<script data-source="var  x = 5;">var x=5;</script><p>var  x = 5;</p>'
+
+
+@pytest.mark.asyncio
+async def test_non_ascii_bytes_pipeline():
+    """ testing non-ASCII pages are scanned and hashed as UTF-8 bytes """
+    test_app = Quart(__name__)
+
+    @test_app.route("/non_ascii")
+    def non_ascii():
+        return """<html>
+    <body>
+        <p>  Café — 日本語  </p>
+        <script>
+            var greeting  =  'héllo wörld ✓';
+        </script>
+    </body>
+</html>"""
+
+    minify_instance = Minify(app=test_app, html=True, js=True)
+
+    test_client = test_app.test_client()
+    resp = await test_client.get("/non_ascii")
+    data = await resp.get_data()
+
+    assert "<p>Café — 日本語</p>".encode("utf8") in data
+    assert "var greeting='héllo wörld ✓';".encode("utf8") in data
+    # Fragments are hashed from the raw bytes of the body
+    assert all(isinstance(key, bytes) for key in minify_instance.hashes)
+
+
+@pytest.mark.asyncio
+async def test_minify_templates_at_load_time():
+    """ testing templates are minified once with Jinja syntax protected """
+    from jinja2 import DictLoader
+    from quart import render_template
+    from quart_minify.jinja import MinifyingLoader
+
+    test_app = Quart(__name__)
+    test_app.jinja_env.loader = DictLoader({
+        "page.html": """<html>
+    <body class="{{ body_class }}">
+        <h1>   {{ title }}   </h1>
+        {# a comment #}
+        {% if show %}<p>  shown  </p>{% endif %}
+        <script>
+            var data = {{ data|tojson }};
+        </script>
+    </body>
+</html>""",
+        "mail.txt": "Hello {{ name }},\n\n  Your order:\n  - item <b>1</b>\n",
+        "note.html": "<p>note</p>\n",
+        "base.html": "<div>{% block content %}{% endblock %}<span>after</span></div>",
+        "child.html": "{% extends 'base.html' %}{% block content %}<p>  child  </p>{% endblock %}",
+        "include.html": "<div>{% include 'note.html' %}<span>after</span></div>",
+    })
+
+    @test_app.route("/template")
+    async def template():
+        return await render_template(
+            "page.html", body_class="a b", title="  Spaced   title  ", show=True, data=[1, 2]
+        )
+
+    @test_app.route("/profiled")
+    async def profiled():
+        return await render_template(
+            "page.html", body_class="a b", title="  Spaced   title  ", show=True, data=[1, 2]
+        )
+
+    @test_app.route("/include")
+    async def include():
+        return await render_template("include.html")
+
+    @test_app.route("/extends")
+    async def extends():
+        return await render_template("child.html")
+
+    minify_instance = Minify(
+        app=test_app, minify_templates=True, profiles={"no_js": {"js": False}}
+    )
+    minify_instance.use_profile("no_js", endpoint="profiled")
+
+    test_client = test_app.test_client()
+    resp = await test_client.get("/template")
+    data = await resp.get_data()
+
+    assert "page.html" in minify_instance.minified_templates
+    assert b'<body class="a b">' in data
+    assert b'<p>shown</p>' in data
+    assert b'var data=[1, 2];' in data
+    # Rendered from a minified template, the after request pass is skipped
+    assert b'<h1>  Spaced   title  </h1>' in data
+
+    # Routes with a profile run it on the rendered page
+    profiled_data = await (await test_client.get("/profiled")).get_data()
+    assert b'<h1>Spaced title</h1>' in profiled_data
+
+    # Included and extended templates keep their end tags
+    assert await (await test_client.get("/include")).get_data() == (
+        b"<div><p>note</p> <span>after</span></div>"
+    )
+    assert await (await test_client.get("/extends")).get_data() == (
+        b"<div><p>child</p><span>after</span></div>"
+    )
+
+    # Only HTML templates are minified
+    source, filename, uptodate = test_app.jinja_env.loader.get_source(
+        test_app.jinja_env, "mail.txt"
+    )
+    assert source == "Hello {{ name }},\n\n  Your order:\n  - item <b>1</b>\n"
+    assert "mail.txt" not in minify_instance.minified_templates
+
+    selective = Minify(minify_templates=lambda name: name.startswith("pages/"))
+    loader = MinifyingLoader(
+        DictLoader({"pages/a.html": "<p>  a  </p>", "b.html": "<p>  b  </p>"}), selective
+    )
+    assert loader.get_source(None, "pages/a.html")[0] == "<p>a</p>"
+    assert loader.get_source(None, "b.html")[0] == "<p>  b  </p>"
+
+
+def test_jinja_protection_roundtrip():
+    """ testing Jinja syntax survives the placeholder roundtrip """
+    from quart_minify.jinja import protect_jinja, restore_jinja
+
+    source = '<a href="{{ url }}" {% if x %}hidden{% endif %}>{# c #}{{ label }}</a>'
+    protected, snippets = protect_jinja(source)
+
+    assert "{{" not in protected
+    assert len(snippets) == 5
+    assert restore_jinja(protected.replace('"', ""), snippets) == (
+        '<a href="{{ url }}" {% if x %}hidden{% endif %}>{# c #}{{ label }}</a>'
+    )
+
+
+@pytest.mark.asyncio
+async def test_minify_block_extension():
+    """ testing the {% minify %} Jinja block extension and its fragment cache """
+    from quart import render_template_string
+    from quart_minify.jinja import MinifyExtension
+
+    test_app = Quart(__name__)
+    test_app.jinja_env.add_extension(MinifyExtension)
+
+    @test_app.route("/minify_block")
+    async def minify_block():
+        return await render_template_string(
+            """<div>
+    {% minify "js" %}
+        var widget  =  {{ size }};  // configure widget
+    {% endminify %}
+    {% minify "css" %}
+        .widget { width : {{ size }}px; }
+    {% endminify %}
+    {% minify %}
+        <p>   {{ title }}   </p>
+    {% endminify %}
+    <section>{% minify %}<p>  a  </p>{% endminify %}<span>b</span></section>
+</div>""",
+            size=10,
+            title="Title",
+        )
+
+    minify_instance = Minify(app=test_app, html=False, js=False, cssless=False)
+
+    test_client = test_app.test_client()
+    resp = await test_client.get("/minify_block")
+    data = await resp.get_data()
+
+    assert b'var widget=10;' in data
+    assert b'.widget{width:10px;}' in data
+    # End tags at the end of a block are kept, the content after it stays outside
+    assert b'<p>Title</p> \n' in data
+    assert b'<section><p>a</p><span>b</span></section>' in data
+    assert len(minify_instance.history) == 4
+
+    # Rendered blocks are cached by their digest
+    await test_client.get("/minify_block")
+    assert len(minify_instance.history) == 4
+
+
+class SlowJSEngine(Engine):
+    """ JavaScript engine counting its calls, slow enough for requests to overlap """
+
+    name = "slow"
+    kind = "js"
+
+    def __init__(self):
+        self.calls = 0
+
+    def minify(self, text):
+        self.calls += 1
+        time.sleep(0.05)
+        return text.strip()
+
+    async def minify_async(self, text):
+        self.calls += 1
+        await asyncio.sleep(0.05)
+        return text.strip()
+
+
+@pytest.mark.asyncio
+async def test_single_flight_inline():
+    """ testing concurrent misses of the same fragment share one async computation """
+    engine = SlowJSEngine()
+    minify_instance = Minify(html=False, engines={"js": engine})
+    content = b"  var x = 5;  "
+
+    results = await asyncio.gather(
+        *(minify_instance.store_minifed_async("js", content, content) for _ in range(10))
+    )
+
+    assert results == ["var x = 5;"] * 10
+    assert engine.calls == 1
+    assert minify_instance.metrics["computed"] == 1
+    assert minify_instance.metrics["coalesced"] == 9
+    assert minify_instance._inflight == {}
+
+
+@pytest.mark.asyncio
+async def test_single_flight_executor():
+    """ testing concurrent requests coalesce misses minified on an executor """
+    engine = SlowJSEngine()
+    test_app = Quart(__name__)
+
+    @test_app.route("/executor")
+    def executor_route():
+        return """<script>
+        var x = 5;
+    </script>"""
+
+    with ThreadPoolExecutor(max_workers=4) as executor:
+        minify_instance = Minify(
+            app=test_app, html=False, engines={"js": engine}, executor=executor
+        )
+
+        test_client = test_app.test_client()
+        responses = await asyncio.gather(*(test_client.get("/executor") for _ in range(5)))
+
+    for resp in responses:
+        assert b'<script>var x = 5;</script>' == await resp.get_data()
+
+    assert engine.calls == 1
+    assert minify_instance.metrics["coalesced"] == 4
+
+
+@pytest.mark.asyncio
+async def test_single_flight_cancelled():
+    """ testing waiters compute again when the shared computation is cancelled """
+    engine = SlowJSEngine()
+    minify_instance = Minify(html=False, engines={"js": engine})
+    content = b"  var x = 5;  "
+
+    first = asyncio.ensure_future(minify_instance.store_minifed_async("js", content, content))
+    await asyncio.sleep(0.01)
+    waiter = asyncio.ensure_future(minify_instance.store_minifed_async("js", content, content))
+    await asyncio.sleep(0.01)
+    first.cancel()
+
+    assert await asyncio.wait_for(waiter, 1) == "var x = 5;"
+    assert first.cancelled()
+    assert engine.calls == 2
+    assert minify_instance._inflight == {}
+    assert await minify_instance.store_minifed_async("js", content, content) == "var x = 5;"
+
+
+@pytest.mark.asyncio
+async def test_stale_while_revalidate():
+    """ testing a cache miss is sent unminified and minified in the background """
+    test_app = Quart(__name__)
+
+    @test_app.route("/swr")
+    def swr():
+        return """<html>
+            <body>
+                <script>  var x = 5;  </script>
+            </body>
+        </html>"""
+
+    minify_instance = Minify(
+        app=test_app, engines={"js": SlowJSEngine()}, stale_while_revalidate=True
+    )
+
+    test_client = test_app.test_client()
+    first = await (await test_client.get("/swr")).get_data()
+    # A second miss while the first is pending does not schedule another task
+    await test_client.get("/swr")
+    assert len(minify_instance._pending) == 1
+    assert len(test_app.background_tasks) == 1
+
+    await asyncio.gather(*test_app.background_tasks)
+    second = await (await test_client.get("/swr")).get_data()
+
+    assert b'<script>  var x = 5;  </script>' in first
+    assert b'<html><body><script>var x = 5;</script>' == second
+    assert len(minify_instance.responses) == 1
+    assert not minify_instance._pending
+
+
+@pytest.mark.asyncio
+async def test_stale_while_revalidate_limit():
+    """ testing background minification is bounded by background_limit """
+    test_app = Quart(__name__)
+
+    @test_app.route("/swr/<int:num>")
+    def swr_num(num):
+        return f"<script>  var x = {num};  </script>"
+
+    minify_instance = Minify(
+        app=test_app,
+        engines={"js": SlowJSEngine()},
+        stale_while_revalidate=True,
+        background_limit=2,
+    )
+
+    test_client = test_app.test_client()
+    for num in range(4):
+        await test_client.get(f"/swr/{num}")
+
+    assert len(minify_instance._pending) == 2
+    await asyncio.gather(*test_app.background_tasks)
+    assert len(minify_instance.responses) == 2
+
+    # Without the cache the background minifications would be dropped
+    with pytest.raises(ValueError):
+        Minify(stale_while_revalidate=True, cache=False)
+
+
+def make_warm_up_app():
+    warm_app = Quart(__name__)
+
+    @warm_app.route("/")
+    def index():
+        return "<p>  index  </p><script>  var x = 1;  </script>"
+
+    @warm_app.route("/about")
+    def about():
+        return "<p>  about  </p>"
+
+    @warm_app.route("/user/<int:user_id>")
+    def user(user_id):
+        return f"<p>  {user_id}  </p>"
+
+    @warm_app.route("/form", methods=["POST"])
+    def form():
+        return "<p>  posted  </p>"
+
+    return warm_app
+
+
+@pytest.mark.asyncio
+async def test_warm_up_routes():
+    """ testing warm up renders the GET routes without parameters """
+    warm_app = make_warm_up_app()
+    minify_instance = Minify(app=warm_app, warm_up=True, bypass=["/about"])
+
+    async with warm_app.test_app():
+        pass
+
+    report = minify_instance.warm_up_report
+    assert report["urls"] == 1
+    assert report["entries"] == 2
+    assert report["duration"] >= 0
+    assert len(minify_instance.responses) == 1
+    assert len(minify_instance.history) == 1
+
+
+@pytest.mark.asyncio
+async def test_warm_up_urls():
+    """ testing warm up of user supplied urls, with background minification """
+    warm_app = make_warm_up_app()
+    minify_instance = Minify(app=warm_app, stale_while_revalidate=True, warm_up_concurrency=1)
+
+    async with warm_app.test_app():
+        report = await minify_instance.warm_up(["/user/1", "/user/2", "/about"])
+
+    assert report["urls"] == 3
+    assert report["entries"] == 3
+    assert len(minify_instance.responses) == 3
+
+
+def test_compiled_plan():
+    """ testing options are compiled into an immutable plan """
+    minify_instance = Minify(
+        html=True, js=True, cssless=False, remove_console=True, console_types=("log",)
+    )
+    plan = minify_instance.plan
+
+    assert plan.tag_passes == (("script", "js"),)
+    assert plan.console_pattern.search("console.log (1)")
+    assert not plan.console_pattern.search("console.warn(1)")
+    assert plan.debugger_pattern is None
+    with pytest.raises(AttributeError):
+        plan.html = False
+
+    # Different options get a different cache namespace
+    assert plan.fingerprint != Minify(html=True, js=True, cssless=False).plan.fingerprint
+
+    minify_instance.remove_debugger = True
+    assert minify_instance.compile_plan().debugger_pattern is not None
+    assert minify_instance.plan.fingerprint != plan.fingerprint
+
+
+def test_lazy_engine_imports():
+    """ testing engine libraries are imported on first use, or by load_engines """
+    import subprocess
+    import sys
+
+    script = """
+import sys
+from quart import Quart
+from quart_minify.minify import Minify
+
+engines = ("minify_html_onepass", "rjsmin", "lesscpy.lessc.parser")
+minify = Minify(app=Quart(__name__), js=False)
+print(all(module not in sys.modules for module in engines))
+minify.load_engines()
+print([module in sys.modules for module in engines])
+"""
+    output = subprocess.check_output(
+        [sys.executable, "-c", script], cwd=os.path.dirname(os.path.dirname(__file__))
+    )
+
+    assert output.split(b"\n")[:2] == [b"True", b"[True, False, True]"]
+
+
+@pytest.mark.asyncio
+async def test_minify_profiles():
+    """ testing profiles attached to blueprints, endpoints and path prefixes """
+    from quart import Blueprint
+
+    test_app = Quart(__name__)
+    admin = Blueprint("admin", __name__)
+    page = """<html>
+            <body>
+                <script>
+                    console.log('debug');
+                    var x = 5;
+                </script>
+            </body>
+        </html>"""
+
+    @test_app.route("/")
+    def public():
+        return page
+
+    @test_app.route("/api/page")
+    def api():
+        return page
+
+    @test_app.route("/api/special")
+    def special():
+        return page
+
+    @test_app.route("/apis/page")
+    def apis():
+        return page
+
+    @admin.route("/admin")
+    def admin_index():
+        return page
+
+    test_app.register_blueprint(admin)
+
+    minify_instance = Minify(
+        app=test_app,
+        remove_console=True,
+        profiles={"html_only": {"js": False, "remove_console": False}, "api": None},
+    )
+    minify_instance.use_profile("html_only", blueprint="admin")
+    minify_instance.use_profile("api", path_prefix="/api")
+    minify_instance.use_profile("html_only", endpoint="special")
+
+    test_client = test_app.test_client()
+    public_data = await (await test_client.get("/")).get_data()
+    admin_data = await (await test_client.get("/admin")).get_data()
+    api_data = await (await test_client.get("/api/page")).get_data()
+    special_data = await (await test_client.get("/api/special")).get_data()
+    apis_data = await (await test_client.get("/apis/page")).get_data()
+
+    assert public_data == b"<html><body><script>var x=5;</script>"
+    assert b"<html><body><script>" in admin_data
+    assert b"console.log('debug');" in admin_data
+    assert api_data == page.encode("utf8")
+    assert special_data == admin_data
+    # Path prefixes match whole segments
+    assert apis_data == public_data
+
+    # Routes are resolved once, profiles have separate cache namespaces
+    assert len(minify_instance._route_plans) == 5
+    namespaces = {key.split(":")[0] for key in minify_instance.responses}
+    assert namespaces == {
+        minify_instance.plan.fingerprint,
+        minify_instance.profile_plans["html_only"].fingerprint,
+    }
+
+
+def test_minify_profiles_validation():
+    """ testing unknown profiles and profile options are rejected """
+    with pytest.raises(ValueError):
+        Minify(profiles={"bad": {"cache": False}})
+
+    with pytest.raises(ValueError):
+        Minify().use_profile("missing", endpoint="index")
+
+
+@pytest.mark.asyncio
+async def test_cache_administration():
+    """ testing cache stats, top entries, invalidation, resize and clear """
+    from hashlib import md5
+
+    test_app = Quart(__name__)
+
+    @test_app.route("/admin_cache/<int:num>")
+    def admin_cache(num):
+        return f"<script>  var x = {'1' * num};  </script>"
+
+    minify_instance = Minify(app=test_app, html=False, cache_limit=10)
+
+    test_client = test_app.test_client()
+    for num in range(1, 5):
+        await test_client.get(f"/admin_cache/{num}")
+    await test_client.get("/admin_cache/1")
+
+    stats = minify_instance.cache_stats()
+    assert stats["history"]["entries"] == 4
+    assert stats["responses"]["entries"] == 4
+    assert stats["responses"]["hits"] == 1
+
+    top = minify_instance.top_entries(count=2)
+    assert [entry["size"] for entry in top["history"]] == [11, 10]
+    assert minify_instance.top_entries(count=1, by="hits")["responses"][0]["hits"] == 1
+
+    content = "  var x = 1111;  ".encode("utf8")
+    assert minify_instance.invalidate(digest=md5(content).hexdigest()) == 1
+    assert minify_instance.invalidate(predicate=lambda key, value: ":js:" in key) == 3
+    assert len(minify_instance.history) == 0
+
+    minify_instance.resize(2)
+    assert len(minify_instance.responses) == 2
+    assert minify_instance.history.limit == 2
+
+    minify_instance.clear_cache()
+    assert len(minify_instance.responses) == len(minify_instance.history) == 0
+
+
+@pytest.mark.asyncio
+async def test_cache_admin_blueprint():
+    """ testing the protected cache admin blueprint """
+    from quart_minify.admin import create_admin_blueprint
+
+    test_app = Quart(__name__)
+
+    @test_app.route("/page")
+    def admin_page():
+        return "<p>  page  </p>"
+
+    minify_instance = Minify(app=test_app)
+    test_app.register_blueprint(
+        create_admin_blueprint(minify_instance, token="secret"), url_prefix="/_minify"
+    )
+
+    test_client = test_app.test_client()
+    await test_client.get("/page")
+    headers = {"X-Minify-Token": "secret"}
+    local = {"client": ("127.0.0.1", 1)}
+    admin = {"headers": headers, "scope_base": local}
+
+    stats = await (await test_client.get("/_minify/stats", **admin)).get_json()
+    assert stats["responses"]["entries"] == 1
+
+    assert (await test_client.get("/_minify/stats", scope_base=local)).status_code == 403
+    resp = await test_client.get(
+        "/_minify/stats", scope_base={"client": ("10.0.0.1", 1)}, headers=headers
+    )
+    assert resp.status_code == 403
+    resp = await test_client.get(
+        "/_minify/stats", headers={"X-Minify-Token": "wrong"}, scope_base=local
+    )
+    assert resp.status_code == 403
+    resp = await test_client.get(
+        "/_minify/stats", headers={"X-Minify-Token": "sécret"}, scope_base=local
+    )
+    assert resp.status_code == 403
+
+    # The blueprint is never built without a token
+    with pytest.raises(ValueError):
+        create_admin_blueprint(minify_instance, token=None)
+    with pytest.raises(ValueError):
+        create_admin_blueprint(minify_instance, token="")
+
+    # The page and the 403 error page
+    resp = await test_client.get("/_minify/entries?by=hits", **admin)
+    entries = await resp.get_json()
+    assert len(entries["responses"]) == 2
+
+    resp = await test_client.post("/_minify/resize", json={"limit": 5}, **admin)
+    assert (await resp.get_json())["responses"]["limit"] == 5
+
+    resp = await test_client.post("/_minify/invalidate", json={"digest": "0"}, **admin)
+    assert (await resp.get_json())["invalidated"] == 0
+
+    resp = await test_client.post("/_minify/clear", **admin)
+    assert (await resp.get_json())["responses"]["entries"] == 0
+
+
+@pytest.mark.asyncio
+async def test_inline_assets(tmp_path):
+    """ testing inlining small local scripts and stylesheets """
+    (tmp_path / "app.js").write_text("var  a = 1 ;")
+    (tmp_path / "app.css").write_text("p {  color: red; }")
+    (tmp_path / "big.js").write_text("var  b = 2 ;" * 100)
+    (tmp_path / "font.css").write_text("p { background: url(bg.png); }")
+
+    test_app = Quart(__name__, static_folder=str(tmp_path), static_url_path="/static")
+
+    @test_app.route("/page")
+    def assets_page():
+        return """<link rel="stylesheet" href="/static/app.css?v=1">
+            <link rel="stylesheet" href="/static/font.css">
+            <link rel="stylesheet" href="https://cdn.example.com/static/app.css">
+            <script src="/static/app.js"></script>
+            <script src="/static/app.js" nonce="abc" id=main integrity="sha384-x"></script>
+            <link rel="stylesheet" href="/static/app.css" media="print" data-theme='dark'>
+            <script src="/static/app.js" defer></script>
+            <script src="/static/big.js"></script>
+            <script src="/static/../app.js"></script>"""
+
+    minify_instance = Minify(app=test_app, inline_assets=True, inline_assets_limit=100)
+    test_client = test_app.test_client()
+    data = await (await test_client.get("/page")).get_data()
+
+    assert b"<style>p{color:red;}</style>" in data
+    assert b"<script>var a=1;</script>" in data
+    # Attributes other than the reference and integrity are kept
+    assert b'<script nonce=abc id=main>var a=1;</script>' in data
+    assert b'<style media=print data-theme=dark>p{color:red;}</style>' in data
+    # Cached per plan
+    assert {key[0] for key in minify_instance.asset_inliner.assets} == {
+        minify_instance.plan.fingerprint
+    }
+    # Relative urls, cross origin, deferred, oversized and outside assets are kept
+    assert b"/static/font.css" in data
+    assert b"https://cdn.example.com/static/app.css" in data
+    assert b"src=/static/app.js defer" in data
+    assert b"/static/big.js" in data
+    assert b"/static/../app.js" in data
+
+    # Modified assets are read again, checked at most once per refresh_interval
+    (tmp_path / "app.js").write_text("var  a = 2 ;")
+    os.utime(tmp_path / "app.js", ns=(0, 0))
+    data = await (await test_client.get("/page")).get_data()
+    assert b"<script>var a=1;</script>" in data
+
+    minify_instance.asset_inliner.refreshed = 0.0
+    data = await (await test_client.get("/page")).get_data()
+    assert b"<script>var a=2;</script>" in data
+
+
+@pytest.mark.asyncio
+async def test_prune_css():
+    """ testing pruning inline styles of the selectors the document misses """
+    test_app = Quart(__name__)
+
+    @test_app.route("/page")
+    def prune_page():
+        return """<style>
+            .card { color: red; }
+            .unused, #main { margin: 0; }
+            .card:hover, .unused:hover { color: blue; }
+            ul > li.item, table td { padding: 0; }
+            @media (max-width: 600px) { .unused { display: none; } }
+            @keyframes spin { from { color: red; } }
+            input[type=text] { border: 0; }
+            .open { display: block; }
+        </style>
+        <div id="main" class="card other"><ul><li class="item">x</li></ul></div>"""
+
+    minify_instance = Minify(app=test_app, prune_css=True, prune_css_keep=(".open",))
+    test_client = test_app.test_client()
+    data = await (await test_client.get("/page")).get_data()
+
+    assert b".card{color:red;}" in data
+    assert b"#main{margin:0;}" in data
+    assert b".card:hover{color:blue;}" in data
+    assert b"ul>li.item{padding:0;}" in data
+    assert b"@keyframes spin" in data
+    assert b".open{display:block;}" in data
+    # Missing classes, tags and emptied @media blocks are removed
+    assert b".unused" not in data
+    assert b"table" not in data
+    assert b"@media" not in data
+    assert b"input[type=text]" not in data
+
+    # Pruned bodies are cached by style digest and document selectors
+    assert len([key for key in minify_instance.history if key.count(":") == 3]) == 1
+
+
+def test_collect_selectors_quoted_attributes():
+    """ testing '>' in quoted attribute values does not hide the classes after it """
+    from quart_minify.css import collect_selectors, prune_css
+
+    used = collect_selectors(
+        """<div data-tip="a > b" class="card"><button onclick='if(a>b){}' id=go class="btn">"""
+    )
+
+    assert used.classes == {"card", "btn"}
+    assert used.ids == {"go"}
+    assert {"div", "button"} <= used.tags
+    assert prune_css(".card{color:red;}.btn{color:blue;}", used) == (
+        ".card{color:red;}.btn{color:blue;}"
+    )
+
+
+@pytest.mark.asyncio
+async def test_extract_blocks(tmp_path):
+    """ testing serving large inline blocks as hashed external resources """
+    test_app = Quart(__name__, instance_path=str(tmp_path / "instance"))
+    blocks = tmp_path / "instance" / "minify_blocks"
+    script = "var  value = 1 ;" * 10
+    data_json = '{"value": 1, "other": [1, 2, 3, 4, 5, 6, 7, 8, 9]}'
+
+    @test_app.route("/page")
+    def extract_page():
+        return f"""<style media="print">p {{  color: red; }}</style>
+            <script nonce="abc" id="app" crossorigin data-main="1">{script}</script>
+            <script type="application/json">{data_json}</script>
+            <script>var  x = 1 ;</script>"""
+
+    minify_instance = Minify(app=test_app, extract_blocks=True, extract_min_size=10)
+    test_client = test_app.test_client()
+    data = await (await test_client.get("/page")).get_data()
+
+    assert re.search(rb"<link rel=stylesheet href=/_minify/blocks/\w+\.css media=print>", data)
+    assert re.search(
+        rb"<script src=/_minify/blocks/\w+\.js nonce=abc id=app crossorigin data-main=1>", data
+    )
+    # Non JavaScript and small blocks stay inline
+    assert b'<script type=application/json>' in data
+    assert b'<script>var x=1;</script>' in data
+
+    url = re.search(rb"/_minify/blocks/\w+\.js", data).group(0).decode()
+    resp = await test_client.get(url)
+    assert resp.status_code == 200
+    assert resp.content_type == "text/javascript; charset=utf-8"
+    assert "immutable" in resp.headers["Cache-Control"]
+    assert await resp.get_data() == b"var value=1;" * 10
+
+    # Written to a private directory of the instance folder, served after an
+    # eviction and by other workers
+    names = re.findall(rb"/_minify/blocks/(\w+\.\w+)", data)
+    assert set(os.listdir(blocks)) == {name.decode() for name in names}
+    assert os.stat(blocks).st_mode & 0o777 == 0o700
+    minify_instance.block_extractor.blocks.clear()
+    assert (await test_client.get(url)).status_code == 200
+
+    worker_app = Quart(__name__)
+    Minify(app=worker_app, extract_blocks=True, extract_dir=str(blocks))
+    resp = await worker_app.test_client().get(url)
+    assert await resp.get_data() == b"var value=1;" * 10
+
+    assert (await test_client.get("/_minify/blocks/missing.js")).status_code == 404
+    assert (await test_client.get("/_minify/blocks/..%2Fsecret.js")).status_code == 404
+    # Files whose content does not match their name are not served
+    (blocks / "0123456789abcdef.js").write_text("alert(1);")
+    assert (await test_client.get("/_minify/blocks/0123456789abcdef.js")).status_code == 404
+
+    # Blocks no page extracted for extract_max_age are removed
+    css_name = next(name.decode() for name in names if name.endswith(b".css"))
+    os.utime(blocks / css_name, (0, 0))
+    assert minify_instance.block_extractor.sweep() == 1
+    assert css_name not in os.listdir(blocks)
+    assert len(minify_instance.responses) == 0
+    assert b"/_minify/blocks/" in await (await test_client.get("/page")).get_data()
+    assert css_name in os.listdir(blocks)
+
+
+@pytest.mark.asyncio
+async def test_chunked_minification():
+    """ testing minifying documents in cached content defined chunks """
+    test_app = Quart(__name__)
+    rows = "".join(
+        f"""
+        <tr class="row">
+          <td>  Item {index}  </td>
+          <td>  <a href="/items/{index}">  view  </a>  <p>note</p> text  </td>
+        </tr>"""
+        for index in range(100)
+    )
+
+    @test_app.route("/page/<name>")
+    def chunked_page(name):
+        return f"""<html>
+          <body>
+            <h1>  Hello {name}  </h1>
+            <table>{rows}
+            </table>
+            <pre>  keep   this  </pre>
+          </body>
+        </html>"""
+
+    minify_instance = Minify(app=test_app, chunked=True, chunk_size=256, cache_limit=1000)
+    test_client = test_app.test_client()
+    first = await (await test_client.get("/page/alice")).get_data()
+    hits = minify_instance.history.hits
+    second = await (await test_client.get("/page/bob")).get_data()
+
+    assert b"<h1>Hello alice</h1>" in first
+    assert b"<h1>Hello bob</h1>" in second
+    assert b"<a href=/items/99> view </a> <p>note</p> text" in first
+    assert b"<pre>  keep   this  </pre>" in first
+    # The name only changes its own chunk
+    assert len(first) - len(b"alice") == len(second) - len(b"bob")
+    assert minify_instance.history.hits - hits > 10
+    assert minify_instance.metrics["chunk_fallbacks"] == 0
+
+
+def test_split_chunks_outside_tags():
+    """ testing chunks are never cut inside tags spanning several lines """
+    from quart_minify.chunks import split_chunks
+
+    text = "".join(
+        f'<a class="link"\n   href="/items/{index}"\n   title="{index}">  {index}  </a>\n'
+        for index in range(200)
+    )
+    chunks = split_chunks(text, 64)
+
+    assert "".join(chunks) == text
+    assert len(chunks) > 10
+    for chunk in chunks:
+        assert chunk.startswith("<a class=")
+        assert chunk.endswith("</a>\n")
+
+    # Quoted '>' and '<' in attribute values do not end the tags
+    text = "".join(
+        f'<div class="row"\n title="a > b"\n data-i="{index}"\n alt="<b> c">  {index}  </div>\n'
+        for index in range(200)
+    )
+    chunks = split_chunks(text, 64)
+
+    assert "".join(chunks) == text
+    assert len(chunks) > 10
+    for chunk in chunks:
+        assert chunk.startswith("<div class=")
+        assert chunk.endswith("</div>\n")
+
+
+@pytest.mark.asyncio
+async def test_volatile_tokens():
+    """ testing caching pages only differing in nonces and CSRF tokens once """
+    from quart_minify.tokens import VOLATILE_TOKENS
+
+    test_app = Quart(__name__)
+
+    @test_app.route("/form/<token>")
+    def token_form(token):
+        return f"""<html>
+            <head><meta name="csrf-token" content="{token}="></head>
+            <body>
+                <script nonce="{token}">  var  x = 1 ;  </script>
+                <form>
+                    <input type="hidden" name="csrf_token" value="{token}">
+                    <p>  Form  </p>
+                </form>
+            </body>
+        </html>"""
+
+    minify_instance = Minify(app=test_app, volatile_tokens=VOLATILE_TOKENS)
+    test_client = test_app.test_client()
+    first = await (await test_client.get("/form/aaa")).get_data()
+    second = await (await test_client.get("/form/bbb")).get_data()
+
+    assert b'<meta name=csrf-token content="aaa=">' in first
+    assert b'<script nonce="bbb">var x=1;</script>' in second
+    assert b'<input type=hidden name=csrf_token value="bbb">' in second
+    assert len(minify_instance.responses) == 1
+    assert minify_instance.responses.hits == 1
+
+
+def test_cache_thread_safety():
+    """ testing concurrent cache operations from many threads """
+    from quart_minify.cache import MinifyCache
+
+    for shards in (1, 4):
+        cache = MinifyCache(50, shards=shards)
+        errors = []
+
+        def hammer(seed):
+            try:
+                for index in range(2000):
+                    key = f"key{(index * seed) % 120}"
+                    cache.set(key, key)
+                    assert cache.get(key) in (key, None)
+                    if index % 50 == 0:
+                        cache.pop(f"key{index % 120}")
+                        cache.invalidate(lambda key, value: key.endswith("7"))
+                        cache.stats()
+            except Exception as e:
+                errors.append(e)
+
+        with ThreadPoolExecutor(max_workers=8) as executor:
+            list(executor.map(hammer, range(1, 17)))
+
+        assert not errors
+        assert len(cache) <= 50
+        assert all(cache.get(key) == key for key in cache.keys())
+
+    cache = MinifyCache(3, shards=8)
+    for index in range(10):
+        cache.set(index, str(index))
+    assert len(cache._shards) == 3
+    assert len(cache) <= 3
+
+    # Resizing below the shard count rebuilds the shards, every one keeps room
+    for policy in ("lru", "s3fifo"):
+        cache = MinifyCache(100, shards=16, policy=policy)
+        for index in range(50):
+            cache.set(index, str(index))
+        cache.get(1)
+        cache.resize(8)
+        assert len(cache._shards) == 8
+        assert len(cache) == 8
+        for index in range(8):
+            cache.set(f"new{index}", str(index))
+        assert len(cache) == 8
+        assert cache.hits == 1
+
+        cache.resize(100)
+        assert len(cache._shards) == 16
+        assert len(cache) == 8
+
+
+def test_cache_compression():
+    """ testing compact cache entries and compression of cold entries """
+    from quart_minify.cache import MinifyCache
+
+    cache = MinifyCache(10, compress_after=3600)
+    text = "<p>été</p>" * 100
+    cache.set("text", text)
+    cache.set("data", text.encode("utf8"))
+    cache.set("small", "<p>x</p>")
+
+    assert cache.stats()["size"] == 2 * len(text.encode("utf8")) + 8
+    assert cache.stats()["compressed"] == 0
+
+    cache.compress()
+    stats = cache.stats()
+    assert stats["compressed"] == 2
+    assert stats["stored"] < stats["size"]
+    assert cache.values() == [text, text.encode("utf8"), "<p>x</p>"]
+
+    assert cache.get("text") == text
+    assert cache.get("data") == text.encode("utf8")
+    assert cache.stats()["compressed"] == 0
+
+    top = cache.top(1, by="hits")[0]
+    assert top["key"] == "text" and top["hits"] == 1
+    assert top["age"] >= top["idle"] >= 0
+
+
+def test_cache_policies():
+    """ testing that the s3fifo policy keeps hot entries through a scan """
+    from quart_minify.cache import MinifyCache
+
+    def replay(policy):
+        cache = MinifyCache(20, policy=policy)
+        for round in range(3):
+            for index in range(10):
+                if cache.get(f"hot{index}") is None:
+                    cache.set(f"hot{index}", "hot")
+        for index in range(100):
+            cache.set(f"scan{index}", "scan")
+        return sum(f"hot{index}" in cache for index in range(10)), cache
+
+    lru_kept, lru = replay("lru")
+    s3fifo_kept, s3fifo = replay("s3fifo")
+    assert lru_kept == 0
+    assert s3fifo_kept == 10
+    assert len(s3fifo) == 20
+    assert s3fifo.evictions == 90
+
+    assert s3fifo.pop("hot0") == "hot"
+    assert s3fifo.invalidate(lambda key, value: value == "scan") == 10
+    for index in range(30):
+        s3fifo.set(f"new{index}", "new")
+    assert len(s3fifo) == 20
+    s3fifo.resize(5)
+    assert len(s3fifo) == 5
+    s3fifo.clear()
+    assert len(s3fifo) == 0
+
+    with pytest.raises(ValueError):
+        MinifyCache(10, policy="random")
+
+    minify_instance = Minify(cache_policy="s3fifo")
+    assert minify_instance.history.policy == minify_instance.responses.policy == "s3fifo"
+
+
+def test_cache_expiry():
+    """ testing cache ttl, generation bumps and versioned namespaces """
+    from quart_minify.cache import MinifyCache
+
+    cache = MinifyCache(10, ttl=60)
+    cache.set("default", "a")
+    cache.set("short", "b", ttl=0)
+    assert cache.get("default") == "a"
+    assert cache.get("short") is None
+    assert "short" not in cache
+    assert cache.stats()["expirations"] == 1
+
+    cache.set("other", "c")
+    assert cache.bump() == 1
+    assert "default" not in cache
+    assert cache.keys() == []
+    assert cache.stats()["stale"] == 2
+    assert cache.get("default") is None
+    cache.set("default", "d")
+    assert cache.get("default") == "d"
+    assert cache.stats()["expirations"] == 2
+
+    class VersionedJSEngine(Engine):
+        name = "versioned"
+        kind = "js"
+        version = "1.0"
+
+        def minify(self, text):
+            return text.strip()
+
+    engine = VersionedJSEngine()
+    minify_instance = Minify(engines={"js": engine}, cache_ttl=60)
+    fingerprint = minify_instance.plan.fingerprint
+    engine.version = "2.0"
+    assert Minify(engines={"js": engine}).plan.fingerprint != fingerprint
+
+    minify_instance.history.set("fragment", "x")
+    minify_instance.responses.set("response", "y")
+    assert minify_instance.bump_generation() == 1
+    assert "fragment" not in minify_instance.history
+    assert "response" not in minify_instance.responses
+
+
+@pytest.mark.asyncio
+async def test_parallel_fragments():
+    """ testing missed fragments of a response are minified in batches on the executor """
+    from concurrent.futures import ProcessPoolExecutor
+
+    scripts = "".join(f"<script>  var x{index} = {index};  // x  </script>" for index in range(6))
+    document = f"<p>  x  </p>{scripts}<script>  var x0 = 0;  // x  </script>"
+
+    with ThreadPoolExecutor(max_workers=4) as executor:
+        engine = SlowJSEngine()
+        minify_instance = Minify(
+            html=False, engines={"js": engine}, executor=executor, executor_batch_size=40
+        )
+        minified = await minify_instance._minify_document_async(document)
+
+        assert minified.count("<script>var x0 = 0;</script>") == 2
+        assert "<script>var x5 = 5;</script>" in minified
+        assert engine.calls == 6
+        assert minify_instance.metrics["computed"] == 6
+        assert minify_instance.metrics["batches"] == 3
+        assert minify_instance._inflight == {}
+
+        # Cached fragments are not sent to the executor again
+        assert await minify_instance._minify_document_async(document) == minified
+        assert minify_instance.metrics["batches"] == 3
+
+        # Requests waiting on a cancelled batch minify the fragments again
+        contents = ["  var cancelled = 1;  ", "  var cancelled = 2;  "]
+        first = asyncio.ensure_future(
+            minify_instance._minify_fragments_async("js", contents, minify_instance.plan)
+        )
+        await asyncio.sleep(0.01)
+        waiter = asyncio.ensure_future(
+            minify_instance._minify_fragments_async("js", contents, minify_instance.plan)
+        )
+        await asyncio.sleep(0.01)
+        first.cancel()
+
+        results = await asyncio.wait_for(waiter, 1)
+        assert results == ["var cancelled = 1;", "var cancelled = 2;"]
+        assert first.cancelled()
+        assert minify_instance._inflight == {}
+
+    with ProcessPoolExecutor(max_workers=2) as executor:
+        minify_instance = Minify(html=False, remove_console=True, executor=executor)
+        minified = await minify_instance._minify_document_async(
+            "<script>  console.log(1); var x = 1;  </script><style>  p { color: red; }  </style>"
+        )
+
+    assert minified == "<script>var x=1;</script><style>p{color:red;}</style>"
+
+
+@pytest.mark.asyncio
+async def test_public_async_api():
+    """ testing minify_html, minify_js, minify_css and minify_many outside requests """
+    minify_instance = Minify(profiles={"raw": None, "no_js": {"js": False}})
+    html = "<html>  <body>  <p>  hello  </p><script>  var x = 1;  </script></body></html>"
+
+    minified = "<html><body><p>hello</p><script>var x=1;</script>"
+    assert await minify_instance.minify_html(html) == minified
+    assert await minify_instance.minify_html(html.encode("utf8")) == minified
+    assert minify_instance.responses.hits == 1
+    assert await minify_instance.minify_js("  var y = 2;  // y  ") == "var y=2;"
+    assert await minify_instance.minify_css(b"  p { color: red; }  ") == "p{color:red;}"
+    assert await minify_instance.minify_html(html, profile="raw") == html
+    # Bytes come back as str when left unminified too
+    assert await minify_instance.minify_html(html.encode("utf8"), profile="raw") == html
+    assert "<script>  var x = 1;  </script>" in await minify_instance.minify_html(
+        html, profile="no_js"
+    )
+
+    with pytest.raises(ValueError):
+        await minify_instance.minify_js("var x;", profile="missing")
+    with pytest.raises(ValueError):
+        await minify_instance.minify_many([("xml", "<x/>")])
+
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        minify_instance = Minify(executor=executor, executor_batch_size=1)
+        items = [("js", f"  var x{index} = {index};  ") for index in range(4)]
+        items += [("css", "  a { color: blue; }  "), ("html", "<p>  x  </p>")]
+        results = await minify_instance.minify_many(items)
+
+    assert results == [f"var x{index}={index};" for index in range(4)] + [
+        "a{color:blue;}", "<p>x"
+    ]
+    assert minify_instance.metrics["batches"] == 5
+
+    class FailingJSEngine(Engine):
+        name = "failing"
+        kind = "js"
+
+        def minify(self, text):
+            raise ValueError("can not minify")
+
+    minify_instance = Minify(engines={"js": FailingJSEngine()})
+    assert await minify_instance.minify_js(b"  var x = 1;  ") == "  var x = 1;  "
+
+
+@pytest.mark.asyncio
+async def test_fragment_profiler():
+    """ testing the slow fragment profiler report """
+
+    class FailingJSEngine(Engine):
+        name = "failing"
+        kind = "js"
+
+        def minify(self, text):
+            if "fail" in text:
+                raise ValueError("can not minify")
+            return text.strip()
+
+    test_app = Quart(__name__)
+
+    @test_app.route("/page/<int:number>")
+    def page(number):
+        big = "var big = 1;" * 100
+        return f"""<script>  var x = {number};  </script>
+    <script>  {big}  </script>
+    <script>  fail();  </script>
+    <style>  p {{ color: red; }}  </style>"""
+
+    minify_instance = Minify(
+        app=test_app, html=False, engines={"js": FailingJSEngine()},
+        profile_fragments=True, profile_size=3,
+    )
+    test_client = test_app.test_client()
+    await test_client.get("/page/1")
+    await test_client.get("/page/2")
+
+    report = minify_instance.profile_report()
+    assert len(report["slowest"]) == 3
+    assert report["misses"] == 6
+    assert report["hits"] == 2
+    assert report["fallbacks"] == 2
+    assert report["largest"][0]["size"] == len("  " + "var big = 1;" * 100 + "  ")
+    assert report["largest"][0]["route"] == "/page/<int:number>"
+    assert report["largest"][0]["cache"] == "miss"
+    seconds = [record["seconds"] for record in report["slowest"]]
+    assert seconds == sorted(seconds, reverse=True)
+    assert {record["kind"] for record in report["largest"]} <= {"js", "css"}
+
+    minify_instance.profiler.reset()
+    assert minify_instance.profile_report()["slowest"] == []
+
+    with pytest.raises(RuntimeError):
+        Minify().profile_report()